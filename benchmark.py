@@ -0,0 +1,752 @@
+"""
+Benchmarks for Éclat de Lune
+
+Run against a local mongod (DATABASE_URL / DATABASE_NAME from .env), e.g.:
+
+    python benchmark.py db-throughput --requests 5000 --concurrency 200
+    python benchmark.py earn-race --requests 5000
+    python benchmark.py serialize --sizes 1000 10000
+    python benchmark.py search --products 50000
+    python benchmark.py suggest --sizes 1000 50000
+    python benchmark.py retier --users 5000000 --batch-size 20000
+    python benchmark.py ratelimit --checks 1000000
+    python benchmark.py load --products 100000 --users 1000000 --workers 4 --output run.json
+    python benchmark.py load --skip-seed --rate 2000 --workers 4 --baseline run.json
+"""
+
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import bson
+
+import database
+from database import get_documents, get_documents_async, model_projection
+from seed import generate_products
+
+
+def _report(name: str, count: int, elapsed: float, **extra):
+    row = {"bench": name, "count": count, "seconds": round(elapsed, 4),
+           "per_sec": round(count / elapsed, 1) if elapsed else None}
+    row.update(extra)
+    print(json.dumps(row))
+    return row
+
+
+def bench_db_throughput(args):
+    """Sync helpers on a 40-thread pool (Starlette's default) vs Motor with N in flight."""
+    filt = {"slug": "selene-sheath-dress"}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=40) as pool:
+        list(pool.map(lambda _: get_documents("product", filt, limit=1), range(args.requests)))
+    _report("sync_get_documents", args.requests, time.perf_counter() - start, threads=40)
+
+    async def run_async():
+        sem = asyncio.Semaphore(args.concurrency)
+
+        async def one():
+            async with sem:
+                await get_documents_async("product", filt, limit=1)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(args.requests)))
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(run_async())
+    _report("async_get_documents", args.requests, elapsed, concurrency=args.concurrency)
+
+
+def bench_earn_race(args):
+    """Fire N concurrent earn_photons at one email and check the exact final balance,
+    then N concurrent retries of one idempotency key and check it is credited once."""
+    import main
+    from main import PhotonEvent, earn_photons
+    from ratelimit import EarnLimiter
+
+    # The default limits would reject earn 31 at one email; keep the limiter on
+    # the path but sized so this run cannot trip it.
+    calls = 2 * args.requests
+    main.earn_limiter = EarnLimiter(events=(calls, calls), photons=(calls * args.amount, calls * args.amount))
+    email = args.email
+
+    async def run():
+        users = database.async_collection("loyaltyuser")
+        await users.delete_many({"email": email})
+        event = PhotonEvent(email=email, kind="view_3d", amount=args.amount)
+        start = time.perf_counter()
+        # Called directly, so the Header() default has to be passed explicitly.
+        await asyncio.gather(*(earn_photons(event, idempotency_key=None) for _ in range(args.requests)))
+        elapsed = time.perf_counter() - start
+        doc = await users.find_one({"email": email})
+        count = await users.count_documents({"email": email})
+
+        retry = PhotonEvent(email=email, kind="view_3d", amount=args.amount, idempotency_key=f"race-{time.time_ns()}")
+        results = await asyncio.gather(*(earn_photons(retry, idempotency_key=None) for _ in range(args.requests)))
+        after = await users.find_one({"email": email})
+        applied = sum(not r.get("duplicate") for r in results)
+        return elapsed, doc["photons"], count, after["photons"] - doc["photons"], applied
+
+    elapsed, photons, count, retried, applied = asyncio.run(run())
+    expected = args.requests * args.amount
+    _report("earn_race", args.requests, elapsed, photons=photons, expected=expected, profiles=count,
+            keyed_retry_credit=retried, keyed_retry_applied=applied)
+    if photons != expected or count != 1:
+        raise SystemExit(f"earn race lost updates: photons={photons} expected={expected} profiles={count}")
+    if retried != args.amount or applied != 1:
+        raise SystemExit(f"keyed retries credited {retried} photons over {applied} applies, "
+                         f"expected {args.amount} once")
+
+
+def bench_lookbook(args):
+    """10k-entry season: Python sort + _id pop vs server-side sort + projection."""
+    from schemas import LookbookEntry
+
+    season = args.season
+    coll = database.get_db()["lookbookentry"]
+    coll.delete_many({"season": season})
+    coll.insert_many([
+        {"season": season, "title": f"Look {i}", "slug": f"{season}-look-{i}",
+         "image": f"https://img.example/{i}.jpg", "product_slugs": [f"p-{i % 50}"],
+         "order": (i * 7919) % args.entries, "notes": "x" * 200}
+        for i in range(args.entries)
+    ])
+    projection = model_projection(LookbookEntry)
+
+    def before():
+        docs = get_documents("lookbookentry", {"season": season})
+        docs.sort(key=lambda d: d.get("order", 0))
+        size = sum(len(bson.encode(d)) for d in docs)
+        for d in docs:
+            d.pop("_id", None)
+        return size
+
+    def after():
+        docs = get_documents("lookbookentry", {"season": season}, sort=[("order", 1)], projection=projection)
+        return sum(len(bson.encode(d)) for d in docs)
+
+    try:
+        for name, fn in (("lookbook_before", before), ("lookbook_after", after)):
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                size = fn()
+                timings.append(time.perf_counter() - start)
+            timings.sort()
+            _report(name, args.entries, timings[len(timings) // 2], bytes=size, repeat=args.repeat)
+    finally:
+        coll.delete_many({"season": season})
+
+
+def _rss_bytes() -> int:
+    """Current resident set size (Linux ``/proc``; elsewhere the getrusage peak)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        import resource
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def bench_export(args):
+    """Stream the catalog export at two sizes; peak RSS during the stream must not grow with size."""
+    from main import export_products
+    from seed import load_fixtures
+
+    prefix = "bench-export"
+    coll = database.get_db()["product"]
+
+    async def drain(fmt):
+        response = await export_products(format=fmt, batch_size=args.batch_size)
+        total = 0
+        gc.collect()
+        # Sampled per chunk, so allocations outside the Python heap (driver
+        # buffers, BSON decoding) count too.
+        base = peak = _rss_bytes()
+        async for chunk in response.body_iterator:
+            total += len(chunk)
+            peak = max(peak, _rss_bytes())
+        return total, peak - base
+
+    async def run():
+        peaks, inserted = [], 0
+        for size in (args.products // 10, args.products):
+            await load_fixtures({"product": itertools.islice(generate_products(size, prefix), inserted, None)}, 5000)
+            inserted = size
+            start = time.perf_counter()
+            total, peak = await drain(args.format)
+            peaks.append(peak)
+            _report("export", size, time.perf_counter() - start, bytes=total, rss_growth_bytes=peak)
+        return peaks
+
+    coll.delete_many({"slug": {"$regex": f"^{prefix}-"}})
+    try:
+        peaks = asyncio.run(run())
+    finally:
+        coll.delete_many({"slug": {"$regex": f"^{prefix}-"}})
+
+    # RSS moves in pages and allocator arenas, so allow a fixed slack on top.
+    if peaks[1] > peaks[0] * 2 + args.rss_slack_mb * 1024 * 1024:
+        raise SystemExit(f"export RSS grew with catalog size: {peaks[0]} -> {peaks[1]} bytes")
+
+
+def bench_serialize(args):
+    """FastAPI's response_model path vs one-pass TypeAdapter validate + dump_json."""
+    from typing import List
+
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+    from fastapi.utils import create_response_field
+
+    from main import fast_json
+    from schemas import Product
+
+    field = create_response_field(name="response", type_=List[Product])
+
+    def timed(fn, docs):
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            size = fn(docs)
+            timings.append(time.perf_counter() - start)
+        timings.sort()
+        return timings[len(timings) // 2], size
+
+    async def fastapi_default(docs):
+        content = await serialize_response(field=field, response_content=docs, is_coroutine=True)
+        return len(JSONResponse(content).body)
+
+    paths = {
+        "fastapi_response_model": lambda docs: asyncio.run(fastapi_default(docs)),
+        "typeadapter_dump_json": lambda docs: len(fast_json(List[Product], docs).body),
+    }
+    try:
+        import orjson
+        paths["orjson_unvalidated"] = lambda docs: len(orjson.dumps(docs))
+    except ImportError:
+        pass
+
+    for count in args.sizes:
+        docs = list(generate_products(count, "bench-serialize"))
+        for name, fn in paths.items():
+            elapsed, size = timed(fn, docs)
+            _report(f"serialize_{name}", count, elapsed, bytes=size, repeat=args.repeat)
+
+
+async def _http_request(reader, writer, host: str, method: str, path: str, body: bytes = None):
+    """Minimal keep-alive HTTP/1.1 request; returns (status, body_size)."""
+    head = f"{method} {path} HTTP/1.1\r\nHost: {host}\r\n"
+    if body is not None:
+        head += f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+    writer.write(head.encode() + b"\r\n" + (body or b""))
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length, chunked = 0, False
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        name = name.strip().lower()
+        if name == "content-length":
+            length = int(value)
+        elif name == "transfer-encoding" and "chunked" in value:
+            chunked = True
+    if not chunked:
+        await reader.readexactly(length)
+        return status, length
+    size = 0
+    while True:
+        chunk = int((await reader.readline()).split(b";")[0], 16)
+        await reader.readexactly(chunk + 2)
+        size += chunk
+        if chunk == 0:
+            return status, size
+
+
+_CONNECTION_ERRORS = (OSError, asyncio.IncompleteReadError, ValueError, IndexError)
+
+
+async def _drive(host: str, port: int, specs, concurrency: int, duration: float, rate: float = None,
+                 seed: int = 0):
+    """Drive ``specs`` ((name, method, path, body) tuples) for ``duration`` seconds.
+
+    Closed loop by default: ``concurrency`` keep-alive connections each issue
+    the next request as soon as the previous one returns. With ``rate`` the
+    load is open loop: Poisson arrivals at ``rate`` req/s share a pool of
+    ``concurrency`` connections, and latency is measured from the scheduled
+    arrival time so queueing delay is not hidden (no coordinated omission).
+    """
+    import random
+
+    rng = random.Random(seed)
+    samples = []
+    deadline = time.perf_counter() + duration
+
+    async def one(conn, spec, scheduled):
+        name, method, path, body = spec
+        reader, writer = conn
+        try:
+            status, _ = await _http_request(reader, writer, host, method, path, body)
+        except _CONNECTION_ERRORS:
+            writer.close()
+            samples.append((name, time.perf_counter() - scheduled, 0))
+            return await asyncio.open_connection(host, port)
+        samples.append((name, time.perf_counter() - scheduled, status))
+        return conn
+
+    if rate is None:
+        async def client():
+            conn = await asyncio.open_connection(host, port)
+            try:
+                while time.perf_counter() < deadline:
+                    conn = await one(conn, rng.choice(specs), time.perf_counter())
+            finally:
+                conn[1].close()
+
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        return samples
+
+    pool = asyncio.Queue()
+    for _ in range(concurrency):
+        pool.put_nowait(await asyncio.open_connection(host, port))
+
+    async def arrival(spec, scheduled):
+        conn = await pool.get()
+        pool.put_nowait(await one(conn, spec, scheduled))
+
+    tasks = []
+    next_at = time.perf_counter()
+    while next_at < deadline:
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(arrival(rng.choice(specs), next_at)))
+        next_at += rng.expovariate(rate)
+    await asyncio.gather(*tasks)
+    while not pool.empty():
+        pool.get_nowait()[1].close()
+    return samples
+
+
+def _percentile(sorted_values, pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * pct / 100))]
+
+
+def _summarize(samples, duration: float) -> dict:
+    latencies = sorted(s[1] for s in samples)
+    errors = sum(1 for s in samples if not 200 <= s[2] < 400)
+    return {
+        "requests": len(samples),
+        "throughput_rps": round(len(samples) / duration, 1),
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "p50_ms": round(_percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(_percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(_percentile(latencies, 99) * 1000, 3),
+    }
+
+
+def _wait_for_port(host: str, port: int, timeout: float = 30.0):
+    import socket
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit(f"server on {host}:{port} did not come up")
+
+
+@contextmanager
+def _serve(host: str, port: int, workers: int):
+    """Run serve.py with ``workers`` workers for the duration of the block."""
+    proc = subprocess.Popen(
+        [sys.executable, "serve.py", "--workers", str(workers), "--host", host,
+         "--port", str(port), "--no-access-log", "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    try:
+        _wait_for_port(host, port)
+        yield
+    finally:
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=60)
+
+
+def bench_search(args):
+    """Uncached /api/products/search latency over --products generated items, against the 20 ms target.
+
+    Times the in-memory ``SearchIndex`` of a catalog snapshot built from the
+    generated products (nothing is cached between runs), or with ``--mongo``
+    the ``$facet`` aggregation the endpoint falls back to without a snapshot.
+    """
+    import random
+
+    import catalog
+    import search
+    from schemas import Product
+    from seed import ADJECTIVES, COLORWAYS, NOUNS
+
+    rng = random.Random(1)
+    words = ADJECTIVES + NOUNS
+    queries = [
+        ("browse", lambda: {}),
+        ("text", lambda: {"q": rng.choice(words)}),
+        ("text_facets", lambda: {"q": rng.choice(words), "colorways": [rng.choice(COLORWAYS)], "in_stock": True,
+                                 "price_max": rng.choice([250.0, 1000.0, 2500.0])}),
+        ("facets_only", lambda: {"colorways": [rng.choice(COLORWAYS)], "sizes": ["M"], "co2_min": 1.0}),
+        ("price_sort", lambda: {"q": rng.choice(words), "sort": "price_desc", "offset": rng.choice([0, 500])}),
+    ]
+
+    def report(name, latencies, products, **extra):
+        latencies.sort()
+        p99 = _percentile(latencies, 99)
+        _report(f"search_{name}", len(latencies), sum(latencies), products=products,
+                p50_ms=round(_percentile(latencies, 50) * 1000, 2),
+                p95_ms=round(_percentile(latencies, 95) * 1000, 2),
+                p99_ms=round(p99 * 1000, 2), target_ms=20, target_met=p99 < 0.020, **extra)
+        return p99 < 0.020
+
+    if not args.mongo:
+        products = [Product.model_validate(doc) for doc in generate_products(args.products, "bench-search")]
+        start = time.perf_counter()
+        snapshot = catalog.CatalogSnapshot(products, version=1)
+        _report("search_snapshot_build", len(products), time.perf_counter() - start)
+        missed = []
+        for name, make in queries:
+            latencies = []
+            for _ in range(args.repeat):
+                params = {"sort": "relevance", "offset": 0, "limit": 50, **make()}
+                start = time.perf_counter()
+                snapshot.search(**params)
+                latencies.append(time.perf_counter() - start)
+            if not report(name, latencies, len(products), backend="snapshot"):
+                missed.append(name)
+        if missed:
+            raise SystemExit(f"search p99 over 20 ms at {len(products)} products: {', '.join(missed)}")
+        return
+
+    if not database.DATABASE_CONFIGURED:
+        raise SystemExit("--mongo needs DATABASE_URL and DATABASE_NAME")
+    from database import async_collection, ensure_indexes_async
+    from schemas import INDEXES
+    from seed import load_fixtures
+
+    async def run():
+        await ensure_indexes_async({"product": INDEXES["product"]})
+        if not args.skip_seed:
+            start = time.perf_counter()
+            inserted = await load_fixtures({"product": generate_products(args.products, "bench-search")}, 5000)
+            _report("search_seed", inserted["product"], time.perf_counter() - start)
+        total = await async_collection("product").estimated_document_count()
+        for name, make in queries:
+            latencies = []
+            for _ in range(args.repeat):
+                # Straight to Mongo: every run is a catalog-cache miss.
+                params = {"sort": "relevance", "offset": 0, "limit": 50, **make()}
+                start = time.perf_counter()
+                await async_collection("product").aggregate(search.build_pipeline(**params)).to_list(length=1)
+                latencies.append(time.perf_counter() - start)
+            report(name, latencies, total, backend="mongo")
+
+    asyncio.run(run())
+
+
+def bench_suggest(args):
+    """Build the autocomplete index from generated products and time lookups."""
+    import random
+
+    import suggest
+    from seed import ADJECTIVES, NOUNS
+
+    for count in args.sizes:
+        docs = list(generate_products(count, "bench-suggest"))
+        start = time.perf_counter()
+        index = suggest.build_index(docs)
+        _report("suggest_build", count, time.perf_counter() - start, **index.stats())
+
+        rng = random.Random(1)
+        words = [w.lower() for w in ADJECTIVES + NOUNS]
+        queries = [w[:rng.randint(1, len(w))] for w in rng.choices(words, k=args.queries // 2)]
+        queries += [f"{rng.choice(words)} {w[:rng.randint(1, len(w))]}" for w in rng.choices(words, k=args.queries // 2)]
+        latencies = []
+        for q in queries:
+            start = time.perf_counter()
+            index.suggest(q)
+            latencies.append(time.perf_counter() - start)
+        latencies.sort()
+        _report("suggest_lookup", len(queries), sum(latencies), products=count,
+                p50_us=round(_percentile(latencies, 50) * 1e6, 1), p99_us=round(_percentile(latencies, 99) * 1e6, 1))
+
+
+def bench_retier(args):
+    """Re-tier a loyaltyuser collection of --users generated profiles."""
+    from photons import TIERS, parse_thresholds, retier_users
+    from seed import generate_users, load_fixtures
+
+    async def run():
+        if not args.skip_seed:
+            start = time.perf_counter()
+            inserted = await load_fixtures({"loyaltyuser": generate_users(args.users, "bench-retier")}, 10000)
+            _report("retier_seed", inserted["loyaltyuser"], time.perf_counter() - start)
+        tiers = parse_thresholds(args.thresholds) if args.thresholds is not None else TIERS
+        start = time.perf_counter()
+        totals = await retier_users(tiers, args.batch_size)
+        _report("retier", totals["scanned"], time.perf_counter() - start, batch_size=args.batch_size,
+                modified=totals["modified"], batches=totals["batches"])
+
+    asyncio.run(run())
+
+
+def bench_ratelimit(args):
+    """Per-check overhead of the earn rate limiter, hot keys and churning keys."""
+    from ratelimit import EarnLimiter, TokenBucket
+
+    def timed(name, fn, keys, **extra):
+        start = time.perf_counter()
+        for key in keys:
+            fn(key)
+        elapsed = time.perf_counter() - start
+        _report(f"ratelimit_{name}", len(keys), elapsed, us_per_check=round(elapsed / len(keys) * 1e6, 3), **extra)
+
+    n = args.checks
+    hot = [f"user-{i % 100}@example.com" for i in range(n)]
+    churn = [f"user-{i}@example.com" for i in range(n)]
+    bucket = TokenBucket(rate=1e9, burst=1e9, maxsize=args.max_keys)
+    timed("bucket_hot", lambda k: bucket.check((k,)), hot)
+    bucket = TokenBucket(rate=1e9, burst=1e9, maxsize=args.max_keys)
+    timed("bucket_churn", lambda k: bucket.check((k,)), churn, evictions_expected=max(0, n - args.max_keys))
+    limiter = EarnLimiter(events=(1e9, 1e9), photons=(1e9, 1e9), maxsize=args.max_keys)
+    timed("earn_check", lambda k: limiter.check_local(k, "view_3d", 5), hot)
+
+    async def check_async():
+        start = time.perf_counter()
+        for key in hot:
+            await limiter.check(key, "view_3d", 5)
+        elapsed = time.perf_counter() - start
+        _report("ratelimit_earn_check_async", n, elapsed, us_per_check=round(elapsed / n * 1e6, 3))
+
+    asyncio.run(check_async())
+
+
+def bench_workers(args):
+    """Throughput of serve.py at several worker counts."""
+    specs = [(args.path, "GET", args.path, None)]
+    for workers in args.workers:
+        with _serve(args.host, args.port, workers):
+            samples = asyncio.run(_drive(args.host, args.port, specs, args.concurrency, args.duration))
+        summary = _summarize(samples, args.duration)
+        _report("workers", summary["requests"], args.duration, workers=workers, path=args.path, **summary)
+
+
+# Relative weight of each route in the default load mix
+LOAD_MIX = {
+    "GET /api/products": 20,
+    "GET /api/products?category": 10,
+    "GET /api/products/{slug}": 25,
+    "GET /api/products/search": 5,
+    "GET /api/products/suggest": 5,
+    "GET /api/lookbook/{season}": 10,
+    "GET /api/journal": 5,
+    "GET /api/universe/profile": 15,
+    "POST /api/universe/earn": 10,
+    "POST /api/universe/earn/batch": 5,
+    "GET /api/products/export": 0,
+    "GET /api/products?all=true": 0,
+}
+
+
+def _load_specs(args, mix: dict, count: int = 5000):
+    """Concrete requests against the generated dataset, weighted by ``mix``."""
+    import random
+
+    from seed import ADJECTIVES, CATEGORIES, COLORWAYS
+
+    rng = random.Random(args.seed)
+    p, products, users = args.prefix, max(args.products, 1), max(args.users, 1)
+    slug = lambda: f"{p}-{rng.randrange(products):07d}"
+    email = lambda: f"{p}-{rng.randrange(users):07d}@example.com"
+    earn = lambda: json.dumps({"email": email(), "kind": "view_3d", "amount": 5}).encode()
+    batch = lambda: json.dumps([{"email": email(), "kind": "share_ar", "amount": 5} for _ in range(20)]).encode()
+    build = {
+        "GET /api/products": lambda: ("GET", "/api/products", None),
+        "GET /api/products?category": lambda: ("GET", f"/api/products?category={rng.choice(CATEGORIES)}", None),
+        "GET /api/products/{slug}": lambda: ("GET", f"/api/products/{slug()}", None),
+        "GET /api/products/suggest": lambda: (
+            "GET", f"/api/products/suggest?q={rng.choice(ADJECTIVES).lower()[:rng.randint(1, 4)]}", None),
+        "GET /api/products/search": lambda: (
+            "GET", f"/api/products/search?q={rng.choice(ADJECTIVES)}&colorways={rng.choice(COLORWAYS)}"
+                   f"&in_stock=true&price_max={rng.choice([250, 1000, 2500])}".replace(" ", "+"), None),
+        "GET /api/lookbook/{season}": lambda: ("GET", f"/api/lookbook/{p}-season-{rng.randrange(8)}", None),
+        "GET /api/journal": lambda: ("GET", "/api/journal", None),
+        "GET /api/universe/profile": lambda: ("GET", f"/api/universe/profile?email={email()}", None),
+        "POST /api/universe/earn": lambda: ("POST", "/api/universe/earn", earn()),
+        "POST /api/universe/earn/batch": lambda: ("POST", "/api/universe/earn/batch", batch()),
+        "GET /api/products/export": lambda: ("GET", "/api/products/export", None),
+        "GET /api/products?all=true": lambda: ("GET", "/api/products?all=true", None),
+    }
+    names = [n for n, w in mix.items() if w > 0]
+    weights = [mix[n] for n in names]
+    return [(name, *build[name]()) for name in rng.choices(names, weights, k=count)]
+
+
+def bench_load(args):
+    """Seed a generated dataset, drive every route, report per-route latency as JSON."""
+    from seed import generated_fixtures, load_fixtures
+
+    if not args.skip_seed:
+        fixtures = generated_fixtures(args.products, args.lookbook, args.journal, args.users, args.prefix)
+        start = time.perf_counter()
+        inserted = asyncio.run(load_fixtures(fixtures))
+        _report("seed", sum(inserted.values()), time.perf_counter() - start, inserted=inserted)
+
+    mix = dict(LOAD_MIX)
+    for item in args.mix or []:
+        name, _, weight = item.rpartition("=")
+        if name not in mix:
+            raise SystemExit(f"unknown route in --mix: {name}")
+        mix[name] = float(weight)
+    specs = _load_specs(args, mix)
+
+    def run():
+        return asyncio.run(_drive(args.host, args.port, specs, args.concurrency, args.duration, args.rate, args.seed))
+
+    if args.workers:
+        with _serve(args.host, args.port, args.workers):
+            samples = run()
+    else:
+        samples = run()
+
+    by_route = {}
+    for sample in samples:
+        by_route.setdefault(sample[0], []).append(sample)
+    result = {
+        "config": {k: v for k, v in vars(args).items() if k not in ("func", "needs_db")},
+        "overall": _summarize(samples, args.duration),
+        "routes": {name: _summarize(rows, args.duration) for name, rows in sorted(by_route.items())},
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        result["vs_baseline"] = {
+            name: {
+                metric: round(stats[metric] / base[metric], 3) if base.get(metric) else None
+                for metric in ("throughput_rps", "p95_ms", "p99_ms")
+            }
+            for name, stats in result["routes"].items()
+            if (base := baseline.get("routes", {}).get(name))
+        }
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("db-throughput", help="sync vs async get_documents throughput")
+    p.add_argument("--requests", type=int, default=5000)
+    p.add_argument("--concurrency", type=int, default=200)
+    p.set_defaults(func=bench_db_throughput, needs_db=True)
+
+    p = sub.add_parser("earn-race", help="concurrent earn_photons at one email, asserts final balance")
+    p.add_argument("--requests", type=int, default=5000)
+    p.add_argument("--amount", type=int, default=5)
+    p.add_argument("--email", default="race@bench.local")
+    p.set_defaults(func=bench_earn_race, needs_db=True)
+
+    p = sub.add_parser("lookbook", help="server-side sort/projection vs Python sort on a large season")
+    p.add_argument("--entries", type=int, default=10000)
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--season", default="bench-season")
+    p.set_defaults(func=bench_lookbook, needs_db=True)
+
+    p = sub.add_parser("export", help="streaming catalog export, asserts flat peak RSS")
+    p.add_argument("--products", type=int, default=100000)
+    p.add_argument("--batch-size", type=int, default=1000)
+    p.add_argument("--rss-slack-mb", type=float, default=16.0)
+    p.add_argument("--format", choices=["ndjson", "json"], default="ndjson")
+    p.set_defaults(func=bench_export, needs_db=True)
+
+    p = sub.add_parser("serialize", help="list response serialization microbenchmark (no Mongo needed)")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    p.add_argument("--repeat", type=int, default=5)
+    p.set_defaults(func=bench_serialize, needs_db=False)
+
+    p = sub.add_parser("workers", help="serve.py throughput at 1, 2, 4 workers")
+    p.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    p.add_argument("--path", default="/")
+    p.add_argument("--concurrency", type=int, default=64)
+    p.add_argument("--duration", type=float, default=10.0)
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8765)
+    p.set_defaults(func=bench_workers, needs_db=False)
+
+    p = sub.add_parser("search", help="uncached faceted search latency, in memory (--mongo: the fallback)")
+    p.add_argument("--products", type=int, default=50000)
+    p.add_argument("--repeat", type=int, default=200)
+    p.add_argument("--mongo", action="store_true", help="time the Mongo $facet aggregation instead")
+    p.add_argument("--skip-seed", action="store_true", help="with --mongo, reuse products seeded earlier")
+    p.set_defaults(func=bench_search, needs_db=False)
+
+    p = sub.add_parser("suggest", help="autocomplete index build time and lookup latency")
+    p.add_argument("--sizes", type=int, nargs="+", default=[1000, 50000])
+    p.add_argument("--queries", type=int, default=10000)
+    p.set_defaults(func=bench_suggest, needs_db=False)
+
+    p = sub.add_parser("retier", help="bulk re-tiering throughput over generated profiles")
+    p.add_argument("--users", type=int, default=100000)
+    p.add_argument("--batch-size", type=int, default=10000)
+    p.add_argument("--thresholds", default=None, help='e.g. "Lunar=800,Eclipse=4000"')
+    p.add_argument("--skip-seed", action="store_true")
+    p.set_defaults(func=bench_retier, needs_db=True)
+
+    p = sub.add_parser("ratelimit", help="earn rate limiter per-check overhead")
+    p.add_argument("--checks", type=int, default=1_000_000)
+    p.add_argument("--max-keys", type=int, default=100_000)
+    p.set_defaults(func=bench_ratelimit, needs_db=False)
+
+    p = sub.add_parser("load", help="seed a generated dataset and load-test every route")
+    p.add_argument("--products", type=int, default=10000)
+    p.add_argument("--lookbook", type=int, default=2000)
+    p.add_argument("--journal", type=int, default=500)
+    p.add_argument("--users", type=int, default=50000)
+    p.add_argument("--prefix", default="bench")
+    p.add_argument("--skip-seed", action="store_true", help="reuse a dataset seeded by an earlier run")
+    p.add_argument("--concurrency", type=int, default=64, help="connections (closed loop) or pool size (--rate)")
+    p.add_argument("--rate", type=float, help="open-loop arrival rate in req/s (default: closed loop)")
+    p.add_argument("--duration", type=float, default=30.0)
+    p.add_argument("--mix", nargs="*", metavar="ROUTE=WEIGHT", help='e.g. "GET /api/products/export=1"')
+    p.add_argument("--workers", type=int, help="start serve.py with N workers (default: use a running server)")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8000)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--output", help="write the JSON report here")
+    p.add_argument("--baseline", help="previous JSON report to compare against")
+    p.set_defaults(func=bench_load, needs_db=True)
+
+    args = parser.parse_args()
+    if args.needs_db and not database.DATABASE_CONFIGURED:
+        parser.error("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
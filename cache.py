@@ -0,0 +1,358 @@
+"""
+In-process Caches
+
+Bounded LRU cache with per-key TTL, plus a read-through wrapper around
+``get_documents_async`` for collections that change rarely (the catalog).
+When Mongo runs as a replica set, ``watch_invalidations`` tails change streams
+so writes from any process invalidate this process's cache; on a standalone
+mongod it gives up and the cache falls back to TTL-only expiry.
+
+``profile_cache`` holds loyalty profiles per email, written through by earns
+and kept in step across workers by ``watch_profiles``.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Hashable, Iterable, Optional, Sequence, Tuple
+
+import bson
+from pymongo.errors import OperationFailure, PyMongoError
+
+from database import get_documents_async
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class TTLCache:
+    """LRU cache whose entries also expire after a per-key TTL (seconds)."""
+
+    def __init__(self, maxsize: int = 256, ttl: float = 60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                self.misses += 1
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        """Like ``get`` but without touching LRU order or hit/miss counters."""
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING or entry[0] <= time.monotonic():
+                return default
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def invalidate(self, predicate=None) -> int:
+        """Drop every entry (or those whose key matches ``predicate``)."""
+        with self._lock:
+            if predicate is None:
+                dropped = len(self._data)
+                self._data.clear()
+                return dropped
+            keys = [k for k in self._data if predicate(k)]
+            for k in keys:
+                del self._data[k]
+            return len(keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+catalog_cache = TTLCache(
+    maxsize=int(os.getenv("CATALOG_CACHE_SIZE", "256")),
+    ttl=float(os.getenv("CATALOG_CACHE_TTL", "60")),
+)
+
+
+def _query_key(collection_name: str, *parts) -> tuple:
+    return (collection_name, json.dumps(parts, sort_keys=True, default=str))
+
+
+def content_etag(docs: list) -> str:
+    """Strong ETag (quoted) over the BSON encoding of ``docs``"""
+    digest = hashlib.blake2b(digest_size=16)
+    for d in docs:
+        digest.update(bson.encode(d))
+    return f'"{digest.hexdigest()}"'
+
+
+async def get_documents_etag(collection_name: str, filter_dict: dict = None, limit: int = None,
+                             sort: Sequence[Tuple[str, int]] = None, projection: Optional[dict] = None,
+                             skip: int = None, after: Optional[str] = None, cache: TTLCache = catalog_cache):
+    """Read-through ``get_documents_async`` returning ``(docs, etag)``.
+
+    The ETag is a content hash computed once per cache fill, so it is stable
+    across workers and can be checked on a cache hit without touching Mongo.
+    Cached documents have ``_id`` stripped and are shared between callers, so
+    treat them as read-only; the returned list itself is a fresh copy.
+    """
+    key = _query_key(collection_name, filter_dict or {}, limit or 0, sort, projection, skip or 0, after)
+    entry = cache.get(key, _MISSING)
+    if entry is _MISSING:
+        docs = await get_documents_async(collection_name, filter_dict, limit, sort, projection, skip, after)
+        for d in docs:
+            d.pop("_id", None)
+        entry = (docs, content_etag(docs))
+        cache.set(key, entry)
+    docs, etag = entry
+    return list(docs), etag
+
+
+async def get_documents_cached(collection_name: str, filter_dict: dict = None, limit: int = None,
+                               sort: Sequence[Tuple[str, int]] = None, projection: Optional[dict] = None,
+                               skip: int = None, after: Optional[str] = None, cache: TTLCache = catalog_cache):
+    """Read-through ``get_documents_async`` (see ``get_documents_etag``)"""
+    docs, _ = await get_documents_etag(collection_name, filter_dict, limit, sort, projection, skip, after, cache)
+    return docs
+
+
+_invalidation_listeners = []
+
+
+def on_invalidate(callback):
+    """Register ``callback(collection_name)`` to run whenever a collection is invalidated"""
+    _invalidation_listeners.append(callback)
+    return callback
+
+
+def invalidate_collection(collection_name: str, cache: TTLCache = catalog_cache) -> int:
+    """Drop every cached query against ``collection_name`` and notify listeners."""
+    dropped = cache.invalidate(lambda key: key[0] == collection_name)
+    for listener in _invalidation_listeners:
+        listener(collection_name)
+    return dropped
+
+
+# ---------- Change-stream invalidation ----------
+
+CACHED_COLLECTIONS = ("product", "lookbookentry", "journalpost")
+
+# Error codes: change streams unsupported (standalone), resume point gone.
+_CHANGE_STREAMS_UNSUPPORTED = {40573}
+_RESUME_TOKEN_LOST = {260, 280, 286}
+
+change_stream_state = {"mode": "ttl-only", "events": 0, "last_error": None}
+
+# Resume token checkpointing: at most every N events or S seconds, not per event.
+TOKEN_SAVE_EVERY = int(os.getenv("RESUME_TOKEN_SAVE_EVERY", "100"))
+TOKEN_SAVE_INTERVAL = float(os.getenv("RESUME_TOKEN_SAVE_INTERVAL", "5"))
+
+
+async def watch_invalidations(database, collections: Iterable[str] = CACHED_COLLECTIONS,
+                              cache: TTLCache = catalog_cache, consumer: str = "catalog-cache"):
+    """Invalidate cached queries whenever ``collections`` change in Mongo.
+
+    The resume token is checkpointed in the ``resumetoken`` collection every
+    ``TOKEN_SAVE_EVERY`` events or ``TOKEN_SAVE_INTERVAL`` seconds so a restarted
+    worker picks up roughly where it left off. Replaying a few events is
+    harmless: every (re)open clears the cache anyway.
+    """
+    collections = list(collections)
+    tokens = database["resumetoken"]
+    pipeline = [{"$match": {"ns.coll": {"$in": collections}}}]
+    try:
+        saved = await tokens.find_one({"_id": consumer})
+    except PyMongoError:
+        saved = None
+    resume_after = saved["token"] if saved else None
+    backoff = 1.0
+
+    async def checkpoint(token):
+        await tokens.update_one(
+            {"_id": consumer},
+            {"$set": {"token": token, "updated_at": datetime.now(timezone.utc)}},
+            upsert=True,
+        )
+
+    while True:
+        try:
+            async with database.watch(pipeline, resume_after=resume_after) as stream:
+                change_stream_state["mode"] = "change-streams"
+                # Anything cached before the stream opened may already be stale.
+                for name in collections:
+                    invalidate_collection(name, cache)
+                backoff = 1.0
+                unsaved, saved_at = 0, time.monotonic()
+                async for change in stream:
+                    change_stream_state["events"] += 1
+                    coll = change.get("ns", {}).get("coll")
+                    for name in ([coll] if coll else collections):
+                        invalidate_collection(name, cache)
+                    resume_after = stream.resume_token
+                    unsaved += 1
+                    if unsaved >= TOKEN_SAVE_EVERY or time.monotonic() - saved_at >= TOKEN_SAVE_INTERVAL:
+                        await checkpoint(resume_after)
+                        unsaved, saved_at = 0, time.monotonic()
+                # Stream ended (e.g. dropDatabase "invalidate" event): start fresh.
+                resume_after = None
+        except asyncio.CancelledError:
+            raise
+        except OperationFailure as e:
+            change_stream_state["last_error"] = str(e)[:200]
+            if e.code in _CHANGE_STREAMS_UNSUPPORTED:
+                change_stream_state["mode"] = "ttl-only"
+                logger.info("Change streams unavailable, cache runs TTL-only: %s", e)
+                return
+            if e.code in _RESUME_TOKEN_LOST:
+                logger.warning("Resume token no longer valid, restarting change stream: %s", e)
+                resume_after = None
+                await tokens.delete_one({"_id": consumer})
+                for name in collections:
+                    invalidate_collection(name, cache)
+                continue
+            logger.warning("Change stream failed, retrying in %.0fs: %s", backoff, e)
+        except PyMongoError as e:
+            change_stream_state["last_error"] = str(e)[:200]
+            logger.warning("Change stream failed, retrying in %.0fs: %s", backoff, e)
+        change_stream_state["mode"] = "ttl-only"
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 60.0)
+
+
+# ---------- Loyalty profiles ----------
+
+class ProfileCache:
+    """Per-email ``LoyaltyUser`` documents (email, photons, tier).
+
+    Filled by profile reads and written through by earns with the document
+    the atomic update returned. Earns only add photons, so a write-through
+    carrying fewer photons than the cached entry is a late response and is
+    ignored; change-stream events bypass that check. ``_id -> email`` is
+    remembered alongside so change-stream events, which only carry ``_id``,
+    can find the entry they touch.
+    """
+
+    def __init__(self, maxsize: int = 50_000, ttl: float = 30.0):
+        self.profiles = TTLCache(maxsize, ttl)
+        self._emails = TTLCache(maxsize, ttl)
+        self.state = {"mode": "local-only", "events": 0, "applied": 0, "last_error": None}
+
+    def get(self, email: str) -> Optional[dict]:
+        return self.profiles.get(email)
+
+    def put(self, doc: dict) -> None:
+        doc = dict(doc)
+        _id = doc.pop("_id", None)
+        cached = self.profiles.peek(doc["email"])
+        if cached is not None and cached.get("photons", 0) > doc.get("photons", 0):
+            return
+        self.profiles.set(doc["email"], doc)
+        if _id is not None:
+            self._emails.set(_id, doc["email"])
+
+    def invalidate(self, email: str) -> None:
+        self.profiles.delete(email)
+
+    def apply_change(self, change: dict) -> None:
+        """Fold a ``loyaltyuser`` change event into the cache"""
+        self.state["events"] += 1
+        email = self._emails.peek(change.get("documentKey", {}).get("_id"))
+        if email is None:
+            return
+        cached = self.profiles.peek(email)
+        update = change.get("updateDescription") or {}
+        fields = {k: v for k, v in (update.get("updatedFields") or {}).items() if k in ("photons", "tier")}
+        if change["operationType"] == "update" and cached is not None and not update.get("removedFields"):
+            if fields:
+                # Events arrive in commit order, so apply them as-is: a lower
+                # balance here is a real change, not a late response.
+                self.profiles.set(email, {**cached, **fields})
+                self.state["applied"] += 1
+            return
+        self.invalidate(email)
+
+    def stats(self) -> dict:
+        return {**self.profiles.stats(), **self.state}
+
+
+profile_cache = ProfileCache(
+    maxsize=int(os.getenv("PROFILE_CACHE_SIZE", "50000")),
+    ttl=float(os.getenv("PROFILE_CACHE_TTL", "30")),
+)
+
+
+async def watch_profiles(database, cache: ProfileCache = profile_cache):
+    """Apply other workers' ``loyaltyuser`` writes to this worker's profile cache.
+
+    No resume token: a restarted worker starts with an empty cache, and on
+    every (re)open the cache is cleared since events may have been missed.
+    """
+    pipeline = [
+        {"$match": {"ns.coll": "loyaltyuser"}},
+        {"$project": {"operationType": 1, "documentKey": 1, "updateDescription.removedFields": 1,
+                      "updateDescription.updatedFields.photons": 1, "updateDescription.updatedFields.tier": 1}},
+    ]
+    backoff = 1.0
+    while True:
+        try:
+            async with database.watch(pipeline) as stream:
+                cache.profiles.invalidate()
+                cache.state["mode"] = "change-streams"
+                backoff = 1.0
+                async for change in stream:
+                    cache.apply_change(change)
+        except asyncio.CancelledError:
+            raise
+        except OperationFailure as e:
+            cache.state["last_error"] = str(e)[:200]
+            if e.code in _CHANGE_STREAMS_UNSUPPORTED:
+                cache.state["mode"] = "local-only"
+                logger.info("Change streams unavailable, profile cache is per worker (TTL-bounded): %s", e)
+                return
+            logger.warning("Profile change stream failed, retrying in %.0fs: %s", backoff, e)
+        except PyMongoError as e:
+            cache.state["last_error"] = str(e)[:200]
+            logger.warning("Profile change stream failed, retrying in %.0fs: %s", backoff, e)
+        cache.state["mode"] = "local-only"
+        cache.profiles.invalidate()
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 60.0)
@@ -0,0 +1,168 @@
+"""
+Catalog Snapshot
+
+With ``CATALOG_SNAPSHOT=1`` the whole ``product`` collection is loaded once
+into an immutable, pre-serialized snapshot so ``list_products`` and
+``get_product`` become dictionary lookups with no Mongo I/O on the hot path,
+and ``/api/products/search`` is answered by the snapshot's in-memory
+``search.SearchIndex``. The snapshot is rebuilt in the background and swapped
+atomically whenever the product collection is invalidated (local writes or
+change-stream events) and every ``CATALOG_SNAPSHOT_REFRESH`` seconds.
+"""
+
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import time
+from types import MappingProxyType
+from typing import Dict, List, Mapping, Optional, Tuple
+
+from pydantic import ValidationError
+
+from cache import on_invalidate
+from database import encode_cursor, iter_documents_async, model_projection
+from schemas import Product
+from search import SearchIndex
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_ENABLED = os.getenv("CATALOG_SNAPSHOT", "0") == "1"
+REFRESH_INTERVAL = float(os.getenv("CATALOG_SNAPSHOT_REFRESH", "300"))
+
+
+def _etag(body: bytes) -> str:
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+
+class ProductListing:
+    """Products of one category (or all of them), sorted by slug"""
+
+    __slots__ = ("slugs", "items", "json", "etag")
+
+    def __init__(self, products: List[Tuple[str, bytes]]):
+        self.slugs: Tuple[str, ...] = tuple(slug for slug, _ in products)
+        self.items: Tuple[bytes, ...] = tuple(body for _, body in products)
+        self.json: bytes = b"[" + b",".join(self.items) + b"]"
+        self.etag: str = _etag(self.json)
+
+    def page(self, after: Optional[str], page_size: int) -> Tuple[bytes, str]:
+        """``{items, next_cursor}`` JSON bytes for the page after slug ``after``"""
+        start = bisect.bisect_right(self.slugs, after) if after is not None else 0
+        end = start + page_size
+        next_cursor = None
+        if end < len(self.slugs):
+            next_cursor = encode_cursor({"slug": self.slugs[end - 1]}, [("slug", 1)])
+        body = (b'{"items":[' + b",".join(self.items[start:end]) + b'],"next_cursor":'
+                + json.dumps(next_cursor).encode() + b"}")
+        return body, _etag(body)
+
+
+class CatalogSnapshot:
+    """Immutable view of the product catalog, indexed by slug and category"""
+
+    __slots__ = ("version", "loaded_at", "by_slug", "etag_by_slug", "all", "by_category", "search_index")
+
+    def __init__(self, products: List[Product], version: int):
+        products = sorted(products, key=lambda p: p.slug)
+        encoded = [(p.slug, p.model_dump_json().encode()) for p in products]
+        self.version = version
+        self.loaded_at = time.time()
+        self.by_slug: Mapping[str, bytes] = MappingProxyType(dict(encoded))
+        self.etag_by_slug: Mapping[str, str] = MappingProxyType({s: _etag(b) for s, b in encoded})
+        self.all = ProductListing(encoded)
+        categories: Dict[str, List[Tuple[str, bytes]]] = {}
+        for p, item in zip(products, encoded):
+            categories.setdefault(p.category, []).append(item)
+        self.by_category: Mapping[str, ProductListing] = MappingProxyType(
+            {cat: ProductListing(items) for cat, items in categories.items()}
+        )
+        self.search_index = SearchIndex(products, self.all.items)
+
+    def listing(self, category: Optional[str]) -> ProductListing:
+        if category is None:
+            return self.all
+        return self.by_category.get(category) or ProductListing([])
+
+    def search(self, **params) -> Tuple[bytes, str]:
+        """``SearchIndex.search`` JSON bytes and their ETag"""
+        body = self.search_index.search(**params)
+        return body, _etag(body)
+
+
+current: Optional[CatalogSnapshot] = None
+_state = {"loads": 0, "errors": 0, "last_load_ms": 0.0}
+_refresh_task: Optional[asyncio.Task] = None
+_dirty = False
+
+
+async def load_snapshot() -> CatalogSnapshot:
+    """Build a new snapshot from Mongo and swap it in"""
+    global current
+    start = time.perf_counter()
+    products = []
+    async for doc in iter_documents_async("product", projection=model_projection(Product)):
+        try:
+            products.append(Product.model_validate(doc))
+        except ValidationError as e:
+            logger.warning("Skipping invalid product %r in snapshot: %s", doc.get("slug"), e)
+    # Building the listings and search index is CPU-bound; a thread lets the
+    # event loop keep serving (from the old snapshot) in between.
+    snapshot = await asyncio.to_thread(CatalogSnapshot, products, (current.version + 1) if current else 1)
+    current = snapshot
+    _state["loads"] += 1
+    _state["last_load_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return snapshot
+
+
+async def _refresh():
+    global _refresh_task, _dirty
+    try:
+        while True:
+            _dirty = False
+            try:
+                await load_snapshot()
+            except Exception as e:
+                _state["errors"] += 1
+                logger.warning("Catalog snapshot refresh failed: %s", e)
+            if not _dirty:
+                break
+    finally:
+        _refresh_task = None
+
+
+def request_refresh():
+    """Schedule a rebuild; coalesces with one already running"""
+    global _refresh_task, _dirty
+    if _refresh_task is not None:
+        _dirty = True
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    _refresh_task = loop.create_task(_refresh())
+
+
+@on_invalidate
+def _on_invalidate(collection_name: str):
+    if SNAPSHOT_ENABLED and collection_name == "product":
+        request_refresh()
+
+
+async def refresh_periodically(interval: float = REFRESH_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        request_refresh()
+
+
+def stats() -> dict:
+    return {
+        "enabled": SNAPSHOT_ENABLED,
+        "version": current.version if current else None,
+        "products": len(current.by_slug) if current else 0,
+        "age_s": round(time.time() - current.loaded_at, 1) if current else None,
+        **_state,
+    }
@@ -3,53 +3,494 @@ Database Helper Functions
 
 MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
+
+The plain helpers block on pymongo; the ``*_async`` variants run on Motor so
+``async def`` endpoints can keep many Mongo round-trips in flight at once.
+
+Clients are created lazily, once per process (a forked worker never reuses
+its parent's client), with pool sizing, timeouts, read preference and wire
+compression taken from ``MONGO_*`` environment variables.
 """
 
-from pymongo import MongoClient
+from bson import ObjectId
+from pymongo import InsertOne, MongoClient, ReturnDocument, UpdateOne, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import base64
+import json
+from motor.motor_asyncio import AsyncIOMotorClient
 from datetime import datetime, timezone
 import os
+import threading
+import time
 from dotenv import load_dotenv
-from typing import Union
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple, Type, Union
 from pydantic import BaseModel
 
 # Load environment variables from .env file
 load_dotenv()
 
-_client = None
-db = None
+logger = logging.getLogger(__name__)
 
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
+DATABASE_CONFIGURED = bool(database_url and database_name)
 
-if database_url and database_name:
-    _client = MongoClient(database_url)
-    db = _client[database_name]
+# Set by connect() for the current process; prefer get_db()/get_async_db().
+_client = None
+db = None
+_async_client = None
+async_db = None
+_client_pid = None
+_connect_lock = threading.Lock()
 
-# Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
-    """Insert a single document with timestamp"""
+
+def _env_int(name: str, default: Optional[int]) -> Optional[int]:
+    value = os.getenv(name)
+    return int(value) if value not in (None, "") else default
+
+
+def _compressors() -> Optional[str]:
+    """Requested MONGO_COMPRESSORS, minus codecs whose Python package is missing"""
+    wanted = [c.strip() for c in os.getenv("MONGO_COMPRESSORS", "zstd,snappy,zlib").split(",") if c.strip()]
+    modules = {"zstd": "zstandard", "snappy": "snappy", "zlib": "zlib"}
+    usable = []
+    for codec in wanted:
+        try:
+            __import__(modules.get(codec, codec))
+            usable.append(codec)
+        except ImportError:
+            logger.info("Mongo wire compressor %s unavailable, skipping", codec)
+    return ",".join(usable) or None
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """Connection pool counters, including how long checkouts wait for a connection.
+
+    Check-out start and finish are reported on the same thread (Motor runs
+    pymongo in its executor), so the wait is timed with a thread-local.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checked_in = 0
+        self.checkout_failures: Dict[str, int] = {}
+        self.in_use = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.clears = 0
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+        with self._lock:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+
+    def _checkout_done(self) -> float:
+        started = getattr(self._local, "started", None)
+        self._local.started = None
+        waited = time.perf_counter() - started if started is not None else 0.0
+        self.waiting = max(0, self.waiting - 1)
+        return waited
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            waited = self._checkout_done()
+            self.checked_out += 1
+            self.in_use += 1
+            self.wait_seconds_total += waited
+            self.wait_seconds_max = max(self.wait_seconds_max, waited)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self._checkout_done()
+            reason = str(event.reason)
+            self.checkout_failures[reason] = self.checkout_failures.get(reason, 0) + 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_in += 1
+            self.in_use = max(0, self.in_use - 1)
+
+    def connection_created(self, event):
+        with self._lock:
+            self.created += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.closed += 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.clears += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "open": self.created - self.closed,
+                "in_use": self.in_use,
+                "waiting": self.waiting,
+                "max_waiting": self.max_waiting,
+                "checked_out": self.checked_out,
+                "checked_in": self.checked_in,
+                "checkout_failures": dict(self.checkout_failures),
+                "wait_ms_avg": round(self.wait_seconds_total / self.checked_out * 1000, 3) if self.checked_out else 0.0,
+                "wait_ms_max": round(self.wait_seconds_max * 1000, 3),
+                "pool_cleared": self.clears,
+            }
+
+
+pool_monitor = PoolMonitor()
+# Passed to every client this process creates; metrics listeners append here.
+event_listeners: List = [pool_monitor]
+
+
+def client_options() -> dict:
+    """MongoClient/Motor keyword arguments from the MONGO_* environment"""
+    options = {
+        "maxPoolSize": _env_int("MONGO_MAX_POOL_SIZE", 100),
+        "minPoolSize": _env_int("MONGO_MIN_POOL_SIZE", 0),
+        "maxIdleTimeMS": _env_int("MONGO_MAX_IDLE_TIME_MS", None),
+        "maxConnecting": _env_int("MONGO_MAX_CONNECTING", 2),
+        "waitQueueTimeoutMS": _env_int("MONGO_WAIT_QUEUE_TIMEOUT_MS", None),
+        "connectTimeoutMS": _env_int("MONGO_CONNECT_TIMEOUT_MS", 10000),
+        "serverSelectionTimeoutMS": _env_int("MONGO_SERVER_SELECTION_TIMEOUT_MS", 10000),
+        "socketTimeoutMS": _env_int("MONGO_SOCKET_TIMEOUT_MS", None),
+        "readPreference": os.getenv("MONGO_READ_PREFERENCE", "primary"),
+        "compressors": _compressors(),
+        "appname": os.getenv("MONGO_APP_NAME", "eclat-de-lune-api"),
+        "event_listeners": list(event_listeners),
+    }
+    return {k: v for k, v in options.items() if v is not None}
+
+
+def connect():
+    """Create this process's clients (idempotent; rebuilt after a fork)"""
+    global _client, db, _async_client, async_db, _client_pid
+    if not DATABASE_CONFIGURED:
+        return
+    with _connect_lock:
+        if _client_pid == os.getpid():
+            return
+        options = client_options()
+        _client = MongoClient(database_url, connect=False, **options)
+        db = _client[database_name]
+        _async_client = AsyncIOMotorClient(database_url, connect=False, **options)
+        async_db = _async_client[database_name]
+        _client_pid = os.getpid()
+
+
+def close():
+    """Close this process's clients (e.g. on application shutdown)"""
+    global _client, db, _async_client, async_db, _client_pid
+    with _connect_lock:
+        if _client_pid == os.getpid():
+            _client.close()
+            _async_client.close()
+        _client = db = _async_client = async_db = _client_pid = None
+
+
+def _unavailable():
+    return Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+
+def get_db():
+    """Sync (pymongo) database for this process"""
+    if _client_pid != os.getpid():
+        connect()
     if db is None:
-        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+        raise _unavailable()
+    return db
+
+
+def get_async_db():
+    """Async (Motor) database for this process"""
+    if _client_pid != os.getpid():
+        connect()
+    if async_db is None:
+        raise _unavailable()
+    return async_db
+
+
+def encode_cursor(doc: dict, sort: Sequence[Tuple[str, int]]) -> str:
+    """Opaque keyset cursor holding ``doc``'s values for the sort keys"""
+    raw = json.dumps([doc.get(key) for key, _ in sort], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, sort: Sequence[Tuple[str, int]]) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except ValueError:
+        values = None
+    # Only JSON scalars: a dict would reach the query as an operator expression.
+    if (not isinstance(values, list) or len(values) != len(sort)
+            or not all(v is None or isinstance(v, (str, int, float, bool)) for v in values)):
+        raise ValueError("Invalid pagination cursor")
+    return values
+
+
+def keyset_filter(filter_dict: Optional[dict], sort: Sequence[Tuple[str, int]], after: str) -> dict:
+    """Restrict ``filter_dict`` to documents strictly after ``after`` in ``sort`` order.
 
+    The last sort key must be unique (e.g. a slug) so pages never overlap.
+    """
+    values = decode_cursor(after, sort)
+    branches = []
+    for i, (key, direction) in enumerate(sort):
+        branch = {k: v for (k, _), v in zip(sort[:i], values[:i])}
+        branch[key] = {"$gt" if direction >= 0 else "$lt": values[i]}
+        branches.append(branch)
+    keyset = branches[0] if len(branches) == 1 else {"$or": branches}
+    return {"$and": [filter_dict, keyset]} if filter_dict else keyset
+
+
+def split_page(docs: list, sort: Sequence[Tuple[str, int]], page_size: int):
+    """Split a ``page_size + 1`` fetch into ``(items, next_cursor)``"""
+    if len(docs) <= page_size:
+        return docs, None
+    items = docs[:page_size]
+    return items, encode_cursor(items[-1], sort)
+
+
+def _find(collection, filter_dict: dict = None, limit: int = None, sort: Sequence[Tuple[str, int]] = None,
+          projection: dict = None, skip: int = None, after: str = None):
+    if after:
+        if not sort:
+            raise ValueError("Keyset pagination requires a sort")
+        filter_dict = keyset_filter(filter_dict, sort, after)
+    cursor = collection.find(filter_dict or {}, projection)
+    if sort:
+        cursor = cursor.sort(list(sort))
+    if skip:
+        cursor = cursor.skip(skip)
+    if limit:
+        cursor = cursor.limit(limit)
+    return cursor
+
+
+def model_projection(model: Type[BaseModel]) -> dict:
+    """Projection returning only the model's fields (and never ``_id``)"""
+    projection = {name: 1 for name in model.model_fields}
+    projection["_id"] = 0
+    return projection
+
+
+def _prepare_document(data: Union[BaseModel, dict]) -> dict:
     # Convert Pydantic model to dict if needed
     if isinstance(data, BaseModel):
         data_dict = data.model_dump()
     else:
         data_dict = data.copy()
 
-    data_dict['created_at'] = datetime.now(timezone.utc)
+    now = datetime.now(timezone.utc)
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
+    return data_dict
+
+
+def _prepare_update(data: Union[BaseModel, dict]) -> dict:
+    if isinstance(data, BaseModel):
+        data_dict = data.model_dump(exclude_unset=True)
+    else:
+        data_dict = data.copy()
     data_dict['updated_at'] = datetime.now(timezone.utc)
+    return {"$set": data_dict}
+
+
+def _bulk_ops(items: Sequence[Union[BaseModel, dict]], key: Optional[str]):
+    """InsertOne per item, or an upsert keyed on ``key`` that keeps created_at stable"""
+    ops, docs = [], []
+    for item in items:
+        doc = _prepare_document(item)
+        docs.append(doc)
+        if key is None:
+            ops.append(InsertOne(doc))
+        else:
+            created_at = doc.pop("created_at")
+            ops.append(UpdateOne({key: doc[key]}, {"$set": doc, "$setOnInsert": {"created_at": created_at}},
+                                 upsert=True))
+    return ops, docs
+
+
+def _bulk_statuses(docs: List[dict], key: Optional[str], upserted: Dict[int, object], errors: Dict[int, str],
+                   ordered: bool) -> List[dict]:
+    statuses = []
+    first_error = min(errors) if errors else None
+    for i, doc in enumerate(docs):
+        if i in errors:
+            statuses.append({"status": "error", "error": errors[i]})
+        elif ordered and first_error is not None and i > first_error:
+            statuses.append({"status": "skipped"})
+        elif key is None:
+            # insert_one/InsertOne assign _id on the document client-side
+            statuses.append({"status": "inserted", "id": str(doc["_id"])})
+        elif i in upserted:
+            statuses.append({"status": "inserted", "id": str(upserted[i])})
+        else:
+            statuses.append({"status": "updated"})
+    return statuses
 
-    result = db[collection_name].insert_one(data_dict)
+
+def _bulk_error_details(e: BulkWriteError):
+    details = e.details or {}
+    upserted = {u["index"]: u["_id"] for u in details.get("upserted", [])}
+    errors = {w["index"]: str(w.get("errmsg", ""))[:200] for w in details.get("writeErrors", [])}
+    return upserted, errors
+
+
+# Helper functions for common database operations
+def create_document(collection_name: str, data: Union[BaseModel, dict]):
+    """Insert a single document with timestamp"""
+    result = get_db()[collection_name].insert_one(_prepare_document(data))
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
-    """Get documents from collection"""
-    if db is None:
-        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
-    
-    cursor = db[collection_name].find(filter_dict or {})
-    if limit:
-        cursor = cursor.limit(limit)
-    
+def create_documents(collection_name: str, items: Sequence[Union[BaseModel, dict]], key: Optional[str] = None,
+                     ordered: bool = False) -> List[dict]:
+    """Insert many documents in one bulk_write, or upsert them on ``key``.
+
+    Returns one ``{"status": "inserted"|"updated"|"error"|"skipped", ...}`` per item.
+    """
+    if not items:
+        return []
+    ops, docs = _bulk_ops(items, key)
+    try:
+        result = get_db()[collection_name].bulk_write(ops, ordered=ordered)
+        upserted, errors = result.upserted_ids, {}
+    except BulkWriteError as e:
+        upserted, errors = _bulk_error_details(e)
+    return _bulk_statuses(docs, key, upserted, errors, ordered)
+
+def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None,
+                  sort: Sequence[Tuple[str, int]] = None, projection: Optional[dict] = None, skip: int = None,
+                  after: Optional[str] = None):
+    """Get documents from collection, optionally sorted/projected server-side.
+
+    ``after`` is a cursor from ``split_page``/``encode_cursor`` for keyset pagination.
+    """
+    cursor = _find(get_db()[collection_name], filter_dict, limit, sort, projection, skip, after)
     return list(cursor)
+
+def update_document(collection_name: str, filter_dict: dict, data: Union[BaseModel, dict]):
+    """Update the first matching document and bump updated_at"""
+    result = get_db()[collection_name].update_one(filter_dict, _prepare_update(data))
+    return result.modified_count
+
+def delete_document(collection_name: str, filter_dict: dict):
+    """Delete the first matching document"""
+    result = get_db()[collection_name].delete_one(filter_dict)
+    return result.deleted_count
+
+
+# Async (Motor) variants of the helpers above
+def async_collection(collection_name: str):
+    """Motor collection handle, for operations the helpers don't cover"""
+    return get_async_db()[collection_name]
+
+async def create_document_async(collection_name: str, data: Union[BaseModel, dict]):
+    """Insert a single document with timestamp"""
+    result = await get_async_db()[collection_name].insert_one(_prepare_document(data))
+    return str(result.inserted_id)
+
+async def create_documents_async(collection_name: str, items: Sequence[Union[BaseModel, dict]],
+                                 key: Optional[str] = None, ordered: bool = False) -> List[dict]:
+    """Insert many documents in one bulk_write, or upsert them on ``key``.
+
+    Returns one ``{"status": "inserted"|"updated"|"error"|"skipped", ...}`` per item.
+    """
+    if not items:
+        return []
+    ops, docs = _bulk_ops(items, key)
+    try:
+        result = await get_async_db()[collection_name].bulk_write(ops, ordered=ordered)
+        upserted, errors = result.upserted_ids, {}
+    except BulkWriteError as e:
+        upserted, errors = _bulk_error_details(e)
+    return _bulk_statuses(docs, key, upserted, errors, ordered)
+
+async def get_or_create_document_async(collection_name: str, filter_dict: dict, data: Union[BaseModel, dict],
+                                      projection: Optional[dict] = None):
+    """Return ``(doc, created)``: the existing match, or insert ``data`` in the same round trip.
+
+    One ``find_one_and_update`` upsert with ``$setOnInsert``, so it never
+    writes to an existing document. Needs a unique index on the filter keys:
+    if a concurrent caller inserts first, the loser's upsert fails on that
+    index and the winner's document is read back instead. The ``_id`` is
+    generated here so a created document is returned with it.
+    """
+    collection = get_async_db()[collection_name]
+    doc = {"_id": ObjectId(), **_prepare_document(data)}
+    try:
+        before = await collection.find_one_and_update(
+            filter_dict, {"$setOnInsert": doc}, upsert=True,
+            return_document=ReturnDocument.BEFORE, projection=projection,
+        )
+    except DuplicateKeyError:
+        return await collection.find_one(filter_dict, projection), False
+    if before is not None:
+        return before, False
+    if projection:
+        doc = {k: v for k, v in doc.items() if projection.get(k) or (k == "_id" and projection.get(k, 1))}
+    return doc, True
+
+async def get_documents_async(collection_name: str, filter_dict: dict = None, limit: int = None,
+                              sort: Sequence[Tuple[str, int]] = None, projection: Optional[dict] = None,
+                              skip: int = None, after: Optional[str] = None):
+    """Get documents from collection, optionally sorted/projected server-side.
+
+    ``after`` is a cursor from ``split_page``/``encode_cursor`` for keyset pagination.
+    """
+    cursor = _find(get_async_db()[collection_name], filter_dict, limit, sort, projection, skip, after)
+    return await cursor.to_list(length=None)
+
+async def iter_documents_async(collection_name: str, filter_dict: dict = None,
+                               sort: Sequence[Tuple[str, int]] = None, projection: Optional[dict] = None,
+                               batch_size: int = 1000):
+    """Stream documents without materializing the result set"""
+    cursor = _find(get_async_db()[collection_name], filter_dict, sort=sort, projection=projection)
+    async for doc in cursor.batch_size(batch_size):
+        yield doc
+
+async def update_document_async(collection_name: str, filter_dict: dict, data: Union[BaseModel, dict]):
+    """Update the first matching document and bump updated_at"""
+    result = await get_async_db()[collection_name].update_one(filter_dict, _prepare_update(data))
+    return result.modified_count
+
+async def delete_document_async(collection_name: str, filter_dict: dict):
+    """Delete the first matching document"""
+    result = await get_async_db()[collection_name].delete_one(filter_dict)
+    return result.deleted_count
+
+async def ensure_indexes_async(indexes: Dict[str, List]):
+    """Create the given IndexModels per collection; existing indexes are a no-op.
+
+    A failure on one collection (e.g. duplicate slugs blocking a unique index)
+    is logged and reported without stopping the others.
+    """
+    database = get_async_db()
+    result = {}
+    for collection_name, models in indexes.items():
+        try:
+            result[collection_name] = await database[collection_name].create_indexes(models)
+        except Exception as e:
+            logger.warning("Could not ensure indexes on %s: %s", collection_name, e)
+            result[collection_name] = f"error: {str(e)[:120]}"
+    return result
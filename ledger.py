@@ -0,0 +1,197 @@
+"""
+Photon Event Ledger
+
+Append-only ``photonevent`` collection recording every applied earn that
+carries a client idempotency key, unique on ``(email, idempotency_key)`` and
+expired through a TTL index once clients stop retrying.
+
+The ledger is an audit trail written after the balance update, not the
+guard: the update itself skips keys still in the profile's ``recent_keys``
+(see ``photons.earn_update``), so a key is never marked seen without its
+photons being added, or the other way round. Before updating, ``recorded``
+looks keys up in the ledger, which also catches retries old enough to have
+left ``recent_keys``.
+
+Each worker keeps a bloom filter of every key in the ledger in front of that
+lookup, so a key it has never seen (the common case) costs no query.
+``watch_ledger`` loads it from the collection and keeps it current from a
+change stream on ``photonevent``, so keys recorded by other workers or
+before a restart are in it too. A negative answer is only trusted while
+that watch is running; before the filter is loaded, without change streams
+(standalone server) or after the stream fails, every key is looked up.
+"""
+
+import asyncio
+import hashlib
+import logging
+import math
+import os
+from datetime import datetime, timezone
+from typing import Iterable, List, Set, Tuple
+
+from pymongo.errors import BulkWriteError, OperationFailure, PyMongoError
+
+from cache import _CHANGE_STREAMS_UNSUPPORTED
+from database import async_collection, iter_documents_async
+from photons import RECENT_KEYS
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY = 11000
+
+
+class BloomFilter:
+    """Fixed-size bloom filter sized for ``capacity`` keys at ``error_rate``.
+
+    It never forgets a key; past ``capacity`` only the false-positive rate
+    grows, so ``watch_ledger`` reloads it at twice the size when it is full.
+    """
+
+    def __init__(self, capacity: int = 1_000_000, error_rate: float = 0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1, h2 = int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str) -> None:
+        for p in self._positions(key):
+            self._bits[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self._bits[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    @property
+    def full(self) -> bool:
+        return self.count >= self.capacity
+
+    def stats(self) -> dict:
+        return {
+            "capacity": self.capacity,
+            "error_rate": self.error_rate,
+            "bits": self.size,
+            "hashes": self.hashes,
+            "count": self.count,
+        }
+
+
+BLOOM_CAPACITY = int(os.getenv("IDEMPOTENCY_BLOOM_CAPACITY", "1000000"))
+BLOOM_ERROR_RATE = float(os.getenv("IDEMPOTENCY_BLOOM_ERROR_RATE", "0.01"))
+
+seen_keys = BloomFilter(BLOOM_CAPACITY, BLOOM_ERROR_RATE)
+# True while seen_keys holds every key in the ledger (see watch_ledger).
+synced = False
+_state = {"recorded": 0, "duplicates": 0, "lookups": 0, "bloom_skips": 0, "bloom_false_positives": 0,
+          "record_errors": 0, "bloom_loads": 0, "last_error": None}
+
+
+def _bloom_key(email: str, key: str) -> str:
+    return f"{email}\0{key}"
+
+
+async def recorded(pairs: Iterable[Tuple[str, str]]) -> Set[Tuple[str, str]]:
+    """The ``(email, idempotency_key)`` pairs already in the ledger"""
+    pairs = set(pairs)
+    maybe_seen = {pair for pair in pairs if _bloom_key(*pair) in seen_keys} if synced else pairs
+    _state["bloom_skips"] += len(pairs) - len(maybe_seen)
+    if not maybe_seen:
+        return set()
+    _state["lookups"] += 1
+    found = await async_collection("photonevent").find(
+        {"$or": [{"email": email, "idempotency_key": key} for email, key in maybe_seen]},
+        {"_id": 0, "email": 1, "idempotency_key": 1},
+    ).to_list(length=None)
+    duplicates = {(d["email"], d["idempotency_key"]) for d in found}
+    if synced:
+        _state["bloom_false_positives"] += len(maybe_seen) - len(duplicates)
+    _state["duplicates"] += len(duplicates)
+    return duplicates
+
+
+async def record(entries: List[dict]) -> None:
+    """Append entries (``email``, ``idempotency_key``, ``kind``, ``amount``) for applied earns.
+
+    Entries already present are left alone. The balance is already updated,
+    so a failed insert is logged rather than raised: failing the request
+    would only make the client retry an earn that ``recent_keys`` then skips.
+    """
+    now = datetime.now(timezone.utc)
+    fresh = list({(e["email"], e["idempotency_key"]): {**e, "created_at": now} for e in entries}.values())
+    if not fresh:
+        return
+    try:
+        await async_collection("photonevent").insert_many(fresh, ordered=False)
+    except BulkWriteError as e:
+        errors = [err for err in e.details.get("writeErrors", []) if err["code"] != DUPLICATE_KEY]
+        if errors or e.details.get("writeConcernErrors"):
+            _state["record_errors"] += 1
+            logger.warning("Photon ledger write failed: %s", errors[:1] or e.details.get("writeConcernErrors"))
+    except Exception as e:
+        _state["record_errors"] += 1
+        logger.warning("Photon ledger write failed: %s", e)
+    for doc in fresh:
+        seen_keys.add(_bloom_key(doc["email"], doc["idempotency_key"]))
+    _state["recorded"] += len(fresh)
+
+
+async def _load(database, capacity: int) -> BloomFilter:
+    """A bloom filter of every key currently in the ledger, with room for as many again"""
+    count = await database["photonevent"].estimated_document_count()
+    bloom = BloomFilter(max(capacity, 2 * count), BLOOM_ERROR_RATE)
+    async for doc in iter_documents_async("photonevent", projection={"_id": 0, "email": 1, "idempotency_key": 1},
+                                          batch_size=10000):
+        bloom.add(_bloom_key(doc["email"], doc["idempotency_key"]))
+    return bloom
+
+
+async def watch_ledger(database):
+    """Load ``seen_keys`` from the ledger and keep it current from a change stream.
+
+    The stream is opened before the load, so keys inserted while loading
+    are replayed from it rather than missed. A filter that fills up is
+    reloaded at twice the size.
+    """
+    global seen_keys, synced
+    pipeline = [
+        {"$match": {"ns.coll": "photonevent", "operationType": "insert"}},
+        {"$project": {"fullDocument.email": 1, "fullDocument.idempotency_key": 1}},
+    ]
+    backoff = 1.0
+    while True:
+        try:
+            async with database.watch(pipeline) as stream:
+                seen_keys = await _load(database, BLOOM_CAPACITY)
+                synced = True
+                _state["bloom_loads"] += 1
+                backoff = 1.0
+                async for change in stream:
+                    doc = change["fullDocument"]
+                    seen_keys.add(_bloom_key(doc["email"], doc["idempotency_key"]))
+                    if seen_keys.full:
+                        break
+            continue
+        except asyncio.CancelledError:
+            raise
+        except OperationFailure as e:
+            _state["last_error"] = str(e)[:200]
+            if e.code in _CHANGE_STREAMS_UNSUPPORTED:
+                logger.info("Change streams unavailable, every idempotency key is looked up in the ledger: %s", e)
+                return
+            logger.warning("Ledger change stream failed, retrying in %.0fs: %s", backoff, e)
+        except PyMongoError as e:
+            _state["last_error"] = str(e)[:200]
+            logger.warning("Ledger change stream failed, retrying in %.0fs: %s", backoff, e)
+        finally:
+            synced = False
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, 60.0)
+
+def stats() -> dict:
+    return {**_state, "bloom_synced": synced, "bloom": seen_keys.stats(), "recent_keys": RECENT_KEYS}
@@ -1,14 +1,180 @@
 import os
-from typing import List, Optional
-from fastapi import FastAPI, HTTPException
+import asyncio
+import codecs
+import json
+import logging
+import math
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Any, Dict, Generic, List, Optional, TypeVar, Union
+from fastapi import Body, Depends, FastAPI, Header, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, TypeAdapter, ValidationError
 from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+import database
+from database import (
+    DATABASE_CONFIGURED, async_collection, create_document_async, create_documents_async, ensure_indexes_async,
+    get_async_db, get_or_create_document_async, pool_monitor,
+    decode_cursor, iter_documents_async, model_projection, split_page,
+)
+from cache import (
+    catalog_cache, change_stream_state, get_documents_etag, invalidate_collection, profile_cache, watch_invalidations,
+    watch_profiles,
+)
+import catalog
+import ledger
+import metrics
+import search
+import suggest
+from photons import applied_keys, earn_update, photon_coalescer, tier_for
+from ratelimit import RATE_LIMIT_ENABLED, earn_limiter
+from seed import MINIMAL_FIXTURES, load_fixtures
+from schemas import INDEXES, Product, LookbookEntry, LoyaltyUser, JournalPost, PhotonEvent
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    tasks = []
+    if DATABASE_CONFIGURED:
+        # Clients are created here, inside each worker, never in a pre-fork parent.
+        database.connect()
+        await ensure_indexes_async(INDEXES)
+        tasks.append(asyncio.create_task(watch_invalidations(get_async_db())))
+        tasks.append(asyncio.create_task(ledger.watch_ledger(get_async_db())))
+        if PROFILE_CACHE_WATCH:
+            tasks.append(asyncio.create_task(watch_profiles(get_async_db())))
+        if catalog.SNAPSHOT_ENABLED:
+            try:
+                await catalog.load_snapshot()
+            except Exception as e:
+                logger.warning("Catalog snapshot unavailable, serving from Mongo: %s", e)
+            tasks.append(asyncio.create_task(catalog.refresh_periodically()))
+        if suggest.INDEX_ENABLED:
+            try:
+                await suggest.load_index()
+            except Exception as e:
+                logger.warning("Suggest index unavailable: %s", e)
+    yield
+    for task in tasks:
+        task.cancel()
+    await photon_coalescer.flush()
+    database.close()
+
+
+app = FastAPI(title="Éclat de Lune API", lifespan=lifespan)
+
+PRODUCT_FIELDS = model_projection(Product)
+LOYALTY_FIELDS = model_projection(LoyaltyUser)
+# Profile reads/earns also fetch _id so change events can be matched to cached emails.
+PROFILE_FIELDS = {**LOYALTY_FIELDS, "_id": 1}
+PROFILE_CACHE_WATCH = os.getenv("PROFILE_CACHE_WATCH", "1") == "1"
+
+# Keyset sort orders; the last key is unique so pages never overlap.
+PRODUCT_ORDER = [("slug", 1)]
+LOOKBOOK_ORDER = [("order", 1), ("slug", 1)]
+JOURNAL_ORDER = [("slug", 1)]
+
+PAGE_SIZE = int(os.getenv("PAGE_SIZE", "50"))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+EXPORT_CHUNK_BYTES = 64 * 1024
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "500"))
+BULK_MAX_ITEM_BYTES = int(os.getenv("BULK_MAX_ITEM_BYTES", str(1024 * 1024)))
+EARN_BATCH_MAX = int(os.getenv("EARN_BATCH_MAX", "500"))
+
+# Opt-in: validate and serialize list responses in one pydantic-core pass
+# instead of response_model validation + jsonable_encoder + json.dumps.
+FAST_JSON = os.getenv("FAST_JSON", "0") == "1"
+
+# Cache-Control per cacheable read route; responses also carry a strong ETag.
+CACHE_CONTROL = {
+    "products": os.getenv("CACHE_CONTROL_PRODUCTS", "public, max-age=60, stale-while-revalidate=300"),
+    "product": os.getenv("CACHE_CONTROL_PRODUCT", "public, max-age=60, stale-while-revalidate=300"),
+    "lookbook": os.getenv("CACHE_CONTROL_LOOKBOOK", "public, max-age=300, stale-while-revalidate=3600"),
+    "journal": os.getenv("CACHE_CONTROL_JOURNAL", "public, max-age=300, stale-while-revalidate=3600"),
+    "search": os.getenv("CACHE_CONTROL_SEARCH", "public, max-age=60, stale-while-revalidate=300"),
+}
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "200"))
+
+T = TypeVar("T")
+
+
+class Page(BaseModel, Generic[T]):
+    items: List[T]
+    next_cursor: Optional[str] = None
+
+
+class PageParams:
+    """Query parameters shared by the paginated list endpoints"""
+
+    def __init__(
+        self,
+        cursor: Optional[str] = Query(None, description="next_cursor from the previous page"),
+        page_size: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+        unpaginated: bool = Query(False, alias="all", description="Return the full list (legacy shape)"),
+    ):
+        self.cursor = cursor
+        self.page_size = page_size
+        self.unpaginated = unpaginated
+
+
+@lru_cache(maxsize=None)
+def _adapter(tp) -> TypeAdapter:
+    return TypeAdapter(tp)
+
+
+def fast_json(tp, content, headers: Optional[dict] = None) -> Response:
+    """Validate ``content`` as ``tp`` and dump it straight to JSON bytes"""
+    adapter = _adapter(tp)
+    return Response(adapter.dump_json(adapter.validate_python(content)), media_type="application/json",
+                    headers=headers)
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so ignore any W/ prefix.
+    return any(tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(","))
+
+
+def _respond(request: Request, response: Response, route: str, etag: str, tp, content):
+    """304 if the client already holds ``etag``, else ``content`` with caching headers"""
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL[route]}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    if isinstance(content, bytes):
+        return Response(content, media_type="application/json", headers=headers)
+    if FAST_JSON:
+        return fast_json(tp, content, headers)
+    response.headers.update(headers)
+    return content
+
+
+async def _list_page(request: Request, response: Response, route: str, collection: str, filt: dict, order,
+                     model, page: PageParams):
+    """One keyset page ({items, next_cursor}), or the bare full list with ``?all=true``"""
+    fields = model_projection(model)
+    if page.unpaginated:
+        docs, etag = await get_documents_etag(collection, filt, sort=order, projection=fields)
+        return _respond(request, response, route, etag, List[model], docs)
+    if page.cursor:
+        try:
+            decode_cursor(page.cursor, order)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    docs, etag = await get_documents_etag(
+        collection, filt, limit=page.page_size + 1, sort=order, projection=fields, after=page.cursor
+    )
+    items, next_cursor = split_page(docs, order, page.page_size)
+    return _respond(request, response, route, etag, Page[model], {"items": items, "next_cursor": next_cursor})
 
-from database import db, create_document, get_documents
-from schemas import Product, LookbookEntry, LoyaltyUser, JournalPost
-
-app = FastAPI(title="Éclat de Lune API")
 
 app.add_middleware(
     CORSMiddleware,
@@ -17,15 +183,16 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(metrics.MetricsMiddleware)
 
 
 @app.get("/")
-def root():
+async def root():
     return {"brand": "Éclat de Lune", "tagline": "Wear the sky."}
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     """Quick connectivity check"""
     resp = {
         "backend": "✅ Running",
@@ -33,35 +200,220 @@ def test_database():
         "collections": [],
     }
     try:
-        if db is not None:
+        if DATABASE_CONFIGURED:
             resp["database"] = "✅ Connected"
-            resp["collections"] = db.list_collection_names()
+            resp["collections"] = await get_async_db().list_collection_names()
         return resp
     except Exception as e:
         resp["database"] = f"❌ {str(e)[:120]}"
         return resp
 
 
+# (endpoint, collection, filter, sort) for every hot query in this module
+HOT_QUERIES = [
+    ("list_products", "product", {"category": "New"}, [("slug", 1)]),
+    ("get_product", "product", {"slug": "selene-sheath-dress"}, None),
+    ("get_lookbook", "lookbookentry", {"season": "fall-24"}, [("order", 1), ("slug", 1)]),
+    ("get_profile", "loyaltyuser", {"email": "explain@example.com"}, None),
+    ("list_journal", "journalpost", {}, [("slug", 1)]),
+]
+
+
+def _plan_stages(plan: dict) -> List[str]:
+    stages = [plan.get("stage", "?")]
+    for child in plan.get("inputStages", []) + [plan.get("inputStage")]:
+        if child:
+            stages += _plan_stages(child)
+    return stages
+
+
+@app.get("/test/explain")
+async def explain_queries():
+    """Run explain() on each endpoint's query and flag collection scans"""
+    if not DATABASE_CONFIGURED:
+        raise HTTPException(status_code=503, detail="Database not available")
+    report = []
+    for endpoint, collection, filt, sort in HOT_QUERIES:
+        cursor = async_collection(collection).find(filt)
+        if sort:
+            cursor = cursor.sort(sort)
+        plan = (await cursor.explain())["queryPlanner"]["winningPlan"]
+        # Slot-based engine (MongoDB 7+) nests the classic plan under "queryPlan".
+        stages = _plan_stages(plan.get("queryPlan", plan))
+        report.append({
+            "endpoint": endpoint,
+            "collection": collection,
+            "filter": filt,
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages,
+            # An unfiltered listing scans by design; only filtered scans are a problem.
+            "needs_index": "COLLSCAN" in stages and bool(filt),
+        })
+    return {"queries": report}
+
+
+@app.get("/test/pool")
+async def pool_stats():
+    """Mongo connection pool settings and checkout/wait counters for this worker"""
+    options = {k: v for k, v in database.client_options().items() if k != "event_listeners"}
+    return {"pid": os.getpid(), "options": options, "pool": pool_monitor.stats()}
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Request, Mongo command, pool and cache metrics in Prometheus text format"""
+    pool = pool_monitor.stats()
+    cache = catalog_cache.stats()
+    gauges = {
+        "mongodb_pool_connections_open": ("Open pooled connections", pool["open"]),
+        "mongodb_pool_connections_in_use": ("Checked-out connections", pool["in_use"]),
+        "mongodb_pool_checkouts_waiting": ("Threads waiting for a connection", pool["waiting"]),
+        "mongodb_pool_checkout_wait_ms_max": ("Longest connection checkout wait", pool["wait_ms_max"]),
+        "mongodb_pool_checkout_failures": ("Failed checkouts", sum(pool["checkout_failures"].values())),
+        "catalog_cache_hits": ("Catalog cache hits", cache["hits"]),
+        "catalog_cache_misses": ("Catalog cache misses", cache["misses"]),
+        "catalog_cache_evictions": ("Catalog cache evictions", cache["evictions"]),
+        "catalog_cache_size": ("Catalog cache entries", cache["size"]),
+    }
+    return PlainTextResponse(metrics.render(gauges), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/cache")
+async def cache_stats():
+    """Hit/miss/eviction counters for sizing the in-process caches"""
+    return {"catalog": catalog_cache.stats(), "invalidation": change_stream_state, "snapshot": catalog.stats(),
+            "suggest": suggest.stats(), "idempotency": ledger.stats(), "profiles": profile_cache.stats()}
+
+
+@app.get("/coalescer")
+async def coalescer_stats():
+    """Flush latency/size counters for batched photon writes, and earn rate limiting"""
+    return {**photon_coalescer.stats(), "rate_limit": earn_limiter.stats()}
+
+
 # ---------- Product Endpoints ----------
 
-@app.get("/api/products", response_model=List[Product])
-def list_products(category: Optional[str] = None):
+@app.get("/api/products", response_model=Union[Page[Product], List[Product]])
+async def list_products(request: Request, response: Response, category: Optional[str] = None,
+                        page: PageParams = Depends()):
+    snapshot = catalog.current
+    if snapshot is not None:
+        listing = snapshot.listing(category)
+        if page.unpaginated:
+            return _respond(request, response, "products", listing.etag, None, listing.json)
+        try:
+            after = decode_cursor(page.cursor, PRODUCT_ORDER)[0] if page.cursor else None
+            if after is not None and not isinstance(after, str):
+                raise ValueError("Invalid pagination cursor")
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        body, etag = listing.page(after, page.page_size)
+        return _respond(request, response, "products", etag, None, body)
+
     filt = {"category": category} if category else {}
-    docs = get_documents("product", filt)
-    # Convert Mongo _id to string-less dict for pydantic
-    for d in docs:
-        d.pop("_id", None)
-    return docs
+    return await _list_page(request, response, "products", "product", filt, PRODUCT_ORDER, Product, page)
+
+
+async def _export_chunks(docs, fmt: str):
+    """Encode streamed documents as NDJSON or a JSON array, in ~64KB chunks"""
+    ndjson = fmt == "ndjson"
+    buf = [] if ndjson else ["["]
+    size = 0
+    first = True
+    async for doc in docs:
+        line = json.dumps(doc, ensure_ascii=False, default=str)
+        if ndjson:
+            buf.append(line + "\n")
+        else:
+            buf.append(line if first else "," + line)
+            first = False
+        size += len(line)
+        if size >= EXPORT_CHUNK_BYTES:
+            yield "".join(buf).encode()
+            buf, size = [], 0
+    if not ndjson:
+        buf.append("]")
+    if buf:
+        yield "".join(buf).encode()
+
+
+@app.get("/api/products/export")
+async def export_products(
+    format: str = Query("ndjson", pattern="^(ndjson|json)$"),
+    batch_size: int = Query(EXPORT_BATCH_SIZE, ge=1, le=10000),
+):
+    """Stream the whole catalog with constant memory, for feed partners"""
+    docs = iter_documents_async("product", sort=PRODUCT_ORDER, projection=PRODUCT_FIELDS, batch_size=batch_size)
+    media_type = "application/x-ndjson" if format == "ndjson" else "application/json"
+    return StreamingResponse(_export_chunks(docs, format), media_type=media_type)
+
+
+class FacetCount(BaseModel):
+    value: Union[str, bool]
+    count: int
+
+
+class SearchResult(BaseModel):
+    items: List[Product]
+    total: int
+    facets: Dict[str, List[FacetCount]]
+
+
+@app.get("/api/products/search", response_model=SearchResult)
+async def search_products(
+    request: Request,
+    response: Response,
+    q: Optional[str] = Query(None, max_length=200,
+                             description="Text query over title and description (with the snapshot, "
+                                         "also category and colorways)"),
+    category: Optional[str] = None,
+    colorways: List[str] = Query([], description="Any of these colorways"),
+    sizes: List[str] = Query([], description="Any of these sizes"),
+    in_stock: Optional[bool] = None,
+    price_min: Optional[float] = Query(None, ge=0),
+    price_max: Optional[float] = Query(None, ge=0),
+    co2_min: Optional[float] = Query(None, ge=0),
+    co2_max: Optional[float] = Query(None, ge=0),
+    sort: str = Query("relevance", pattern="^(relevance|slug|price_asc|price_desc)$"),
+    offset: int = Query(0, ge=0, le=10000),
+    page_size: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    """Text search with colorway/size/stock/price/CO2 filters and facet counts"""
+    params = dict(
+        q=q.strip() if q else None, category=category, colorways=sorted(set(colorways)), sizes=sorted(set(sizes)),
+        in_stock=in_stock, price_min=price_min, price_max=price_max, co2_min=co2_min, co2_max=co2_max,
+        sort=sort, offset=offset, limit=page_size,
+    )
+    snapshot = catalog.current
+    if snapshot is not None:
+        body, etag = snapshot.search(**params)
+        return _respond(request, response, "search", etag, None, body)
+    result, etag = await search.search_products(**params)
+    return _respond(request, response, "search", etag, SearchResult, result)
+
+
+@app.get("/api/products/suggest")
+async def suggest_products(q: str = Query(..., min_length=1, max_length=100), limit: int = Query(10, ge=1, le=50)):
+    """Autocomplete: completions for the word being typed and matching products, from memory"""
+    index = suggest.current
+    if index is None:
+        raise HTTPException(status_code=503, detail="Suggest index not loaded")
+    return {"q": q, **index.suggest(q, limit)}
 
 
 @app.get("/api/products/{slug}", response_model=Product)
-def get_product(slug: str):
-    docs = get_documents("product", {"slug": slug}, limit=1)
+async def get_product(request: Request, response: Response, slug: str):
+    snapshot = catalog.current
+    if snapshot is not None:
+        body = snapshot.by_slug.get(slug)
+        if body is None:
+            raise HTTPException(status_code=404, detail="Product not found")
+        return _respond(request, response, "product", snapshot.etag_by_slug[slug], None, body)
+
+    docs, etag = await get_documents_etag("product", {"slug": slug}, limit=1, projection=PRODUCT_FIELDS)
     if not docs:
         raise HTTPException(status_code=404, detail="Product not found")
-    doc = docs[0]
-    doc.pop("_id", None)
-    return doc
+    return _respond(request, response, "product", etag, Product, docs[0])
 
 
 class CreateProductRequest(Product):
@@ -69,146 +421,340 @@ class CreateProductRequest(Product):
 
 
 @app.post("/api/products")
-def create_product(payload: CreateProductRequest):
-    new_id = create_document("product", payload)
+async def create_product(payload: CreateProductRequest):
+    try:
+        new_id = await create_document_async("product", payload)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail=f"Product with slug '{payload.slug}' already exists")
+    suggest.add_product(payload)
+    invalidate_collection("product")
     return {"id": new_id}
 
 
+async def _ndjson_lines(request: Request):
+    """Yield parsed objects from an NDJSON request body as it streams in"""
+    buf = b""
+    async for chunk in request.stream():
+        buf += chunk
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buf.strip():
+        yield buf
+
+
+class _JsonArrayStream:
+    """Incremental parser for a top-level JSON array; ``feed`` returns the items completed so far"""
+
+    WHITESPACE = " \t\n\r"
+
+    def __init__(self, max_item_bytes: int):
+        self.max_item_bytes = max_item_bytes
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.buf = ""
+        self.state = "start"  # start -> first (item or "]") -> sep -> item -> ... -> end
+
+    def feed(self, chunk: bytes, final: bool = False) -> list:
+        buf = self.buf + self.text.decode(chunk, final)
+        items, pos = [], 0
+        while True:
+            while pos < len(buf) and buf[pos] in self.WHITESPACE:
+                pos += 1
+            if pos == len(buf):
+                break
+            if self.state == "end":
+                raise ValueError("Trailing data after the JSON array")
+            if self.state == "start":
+                if buf[pos] != "[":
+                    raise ValueError("Expected a JSON array")
+                self.state, pos = "first", pos + 1
+            elif self.state == "sep":
+                if buf[pos] not in ",]":
+                    raise ValueError("Expected ',' or ']'")
+                self.state, pos = ("item" if buf[pos] == "," else "end"), pos + 1
+            elif self.state == "first" and buf[pos] == "]":
+                self.state, pos = "end", pos + 1
+            else:
+                try:
+                    item, end = self.decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    if final:
+                        raise
+                    break
+                if end == len(buf) and not final:
+                    break  # a trailing number may continue in the next chunk
+                items.append(item)
+                self.state, pos = "sep", end
+        self.buf = buf[pos:]
+        if len(self.buf) > self.max_item_bytes:
+            raise ValueError("JSON array item too large")
+        if final and self.state != "end":
+            raise ValueError("Unterminated JSON array")
+        return items
+
+
+async def _json_array_items(request: Request):
+    """Yield the items of a JSON array request body as it streams in"""
+    parser = _JsonArrayStream(BULK_MAX_ITEM_BYTES)
+    try:
+        async for chunk in request.stream():
+            for item in parser.feed(chunk):
+                yield item
+        for item in parser.feed(b"", final=True):
+            yield item
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Expected a JSON array of products")
+
+
+@app.post("/api/products/bulk")
+async def create_products_bulk(request: Request, ordered: bool = False):
+    """Upsert products keyed on slug from a JSON array or NDJSON (application/x-ndjson) body.
+
+    Both body formats are parsed as they stream in, and items are validated and
+    written in chunks of BULK_CHUNK_SIZE; the response has one status per input
+    item, in input order.
+    """
+    ndjson = "ndjson" in request.headers.get("content-type", "")
+    source = _ndjson_lines(request) if ndjson else _json_array_items(request)
+    parse = CreateProductRequest.model_validate_json if ndjson else CreateProductRequest.model_validate
+    results: List[dict] = []
+    chunk, positions = [], []
+    stopped = flushed = False
+
+    async def flush():
+        nonlocal chunk, positions, stopped, flushed
+        flushed = True
+        statuses = await create_documents_async("product", chunk, key="slug", ordered=ordered)
+        for pos, status in zip(positions, statuses):
+            results[pos] = status
+        stopped = ordered and any(s["status"] == "error" for s in statuses)
+        chunk, positions = [], []
+
+    try:
+        async for raw in source:
+            index = len(results)
+            if stopped:
+                results.append({"status": "skipped"})
+                continue
+            try:
+                product = parse(raw)
+            except ValidationError as e:
+                err = e.errors()[0]
+                results.append({"status": "invalid", "error": f"{'.'.join(map(str, err['loc']))}: {err['msg']}"})
+                if ordered:
+                    if chunk:
+                        await flush()
+                    stopped = True
+                continue
+            results.append(None)
+            chunk.append(product)
+            positions.append(index)
+            if len(chunk) >= BULK_CHUNK_SIZE:
+                await flush()
+        if chunk and not stopped:
+            await flush()
+    finally:
+        # Also when a malformed body or a failed write ends the import part-way:
+        # the chunks already flushed are in Mongo and cached reads must not outlive them.
+        if flushed:
+            invalidate_collection("product")
+    for pos in positions:
+        results[pos] = {"status": "skipped"}
+
+    counts: Dict[str, int] = {}
+    for r in results:
+        counts[r["status"]] = counts.get(r["status"], 0) + 1
+    return {"ok": not any(r["status"] in ("error", "invalid") for r in results), "counts": counts,
+            "results": [{"index": i, **r} for i, r in enumerate(results)]}
+
+
 # ---------- Lookbook Endpoints ----------
 
-@app.get("/api/lookbook/{season}", response_model=List[LookbookEntry])
-def get_lookbook(season: str):
-    docs = get_documents("lookbookentry", {"season": season})
-    docs.sort(key=lambda d: d.get("order", 0))
-    for d in docs:
-        d.pop("_id", None)
-    return docs
+@app.get("/api/lookbook/{season}", response_model=Union[Page[LookbookEntry], List[LookbookEntry]])
+async def get_lookbook(request: Request, response: Response, season: str, page: PageParams = Depends()):
+    return await _list_page(
+        request, response, "lookbook", "lookbookentry", {"season": season}, LOOKBOOK_ORDER, LookbookEntry, page
+    )
 
 
 # ---------- Loyalty Endpoints ----------
 
 @app.get("/api/universe/profile", response_model=LoyaltyUser)
-def get_profile(email: str):
-    docs = get_documents("loyaltyuser", {"email": email}, limit=1)
-    if not docs:
-        # Auto-provision a new profile
-        profile = LoyaltyUser(email=email)
-        create_document("loyaltyuser", profile)
-        return profile
-    doc = docs[0]
+async def get_profile(email: str):
+    cached = profile_cache.get(email)
+    if cached is not None:
+        return cached
+    # Read or auto-provision in one atomic upsert; the unique email index
+    # keeps concurrent first visits from creating duplicate profiles.
+    doc, _ = await get_or_create_document_async(
+        "loyaltyuser", {"email": email}, LoyaltyUser(email=email), projection=PROFILE_FIELDS
+    )
+    profile_cache.put(doc)
     doc.pop("_id", None)
     return doc
 
 
-class PhotonEvent(BaseModel):
-    email: str
-    kind: str  # view_3d, share_ar, recycle
-    amount: int = 5
+def _ledger_entry(event: PhotonEvent) -> dict:
+    return {"email": event.email, "idempotency_key": event.idempotency_key, "kind": event.kind,
+            "amount": event.amount}
 
 
 @app.post("/api/universe/earn")
-def earn_photons(event: PhotonEvent):
-    docs = get_documents("loyaltyuser", {"email": event.email}, limit=1)
-    if not docs:
-        profile = LoyaltyUser(email=event.email, photons=event.amount)
-        create_document("loyaltyuser", profile)
-        return {"ok": True}
-    doc = docs[0]
-    photons = int(doc.get("photons", 0)) + int(event.amount)
-    db["loyaltyuser"].update_one({"_id": doc["_id"]}, {"$set": {"photons": photons}})
-    return {"ok": True, "photons": photons}
+async def earn_photons(event: PhotonEvent, idempotency_key: Optional[str] = Header(None, max_length=128)):
+    """Add photons; a retried request with the same idempotency key (body or header) is applied once"""
+    event.idempotency_key = event.idempotency_key or idempotency_key
+    if event.amount <= 0:
+        raise HTTPException(status_code=400, detail="amount must be positive")
+    # More than a full bucket would be rate limited forever, so it is a bad request.
+    if RATE_LIMIT_ENABLED and event.amount > earn_limiter.max_amount:
+        raise HTTPException(status_code=400, detail=f"amount must be at most {earn_limiter.max_amount:g}")
+    key = event.idempotency_key
+    # A retry of an already applied key answers as a duplicate, not a 429.
+    if key and await ledger.recorded([(event.email, key)]):
+        return await _duplicate_earn(event.email)
+    if RATE_LIMIT_ENABLED:
+        wait = await earn_limiter.check(event.email, event.kind, event.amount)
+        if wait:
+            raise HTTPException(status_code=429, detail="Rate limit exceeded",
+                                headers={"Retry-After": str(math.ceil(wait))})
+    users = async_collection("loyaltyuser")
+    # Single atomic upsert: no read-modify-write, so concurrent earns never lose
+    # increments, the tier is promoted from the new balance in the same write,
+    # and a key still in recent_keys adds nothing. The previous document says
+    # whether it did.
+    before = await users.find_one_and_update(
+        {"email": event.email},
+        earn_update(0, keyed={key: event.amount}) if key else earn_update(event.amount),
+        upsert=True,
+        return_document=ReturnDocument.BEFORE,
+        projection={**PROFILE_FIELDS, "recent_keys": 1},
+    )
+    if before is None:
+        # New profile: its _id is not known here, so leave caching to the next read.
+        photons = event.amount
+    elif key and key in (before.get("recent_keys") or ()):
+        return {"ok": True, "duplicate": True, "photons": before.get("photons", 0),
+                "tier": before.get("tier", "Nova")}
+    else:
+        photons = before.get("photons", 0) + event.amount
+    doc = {"email": event.email, "photons": photons, "tier": tier_for(photons)}
+    if before is not None:
+        profile_cache.put({**doc, "_id": before["_id"]})
+    if key:
+        await ledger.record([_ledger_entry(event)])
+    return {"ok": True, "photons": doc["photons"], "tier": doc["tier"]}
+
+
+async def _duplicate_earn(email: str) -> dict:
+    doc = profile_cache.get(email) or await async_collection("loyaltyuser").find_one({"email": email}, LOYALTY_FIELDS)
+    doc = doc or {}
+    return {"ok": True, "duplicate": True, "photons": doc.get("photons", 0), "tier": doc.get("tier", "Nova")}
+
+
+@app.post("/api/universe/earn/batch")
+async def earn_photons_batch(events: List[Dict[str, Any]] = Body(..., max_length=EARN_BATCH_MAX)):
+    """Validate each event on its own, then coalesce accepted increments into one flush.
+
+    At most ``EARN_BATCH_MAX`` events per request; a longer body is a 422.
+
+    Events carrying an ``idempotency_key`` already in the ledger or in the
+    profile's ``recent_keys`` (or repeated in the batch) are reported as
+    duplicates and not applied again. Events for an email whose update failed
+    are reported as not accepted and can be retried.
+    """
+    results = []
+    accepted_events: List[PhotonEvent] = []
+    for raw in events:
+        try:
+            event = PhotonEvent.model_validate(raw)
+        except ValidationError as e:
+            err = e.errors()[0]
+            results.append({"accepted": False, "error": f"{'.'.join(map(str, err['loc']))}: {err['msg']}"})
+            continue
+        if event.amount <= 0:
+            results.append({"accepted": False, "error": "amount must be positive"})
+            continue
+        if RATE_LIMIT_ENABLED and event.amount > earn_limiter.max_amount:
+            results.append({"accepted": False, "error": f"amount must be at most {earn_limiter.max_amount:g}"})
+            continue
+        results.append({"accepted": True})
+        accepted_events.append(event)
+
+    keyed = {(e.email, e.idempotency_key) for e in accepted_events if e.idempotency_key}
+    duplicates = set()
+    if keyed:
+        # recent_keys is read too: a key applied but not yet in the ledger is
+        # skipped by the update and must not be reported as accepted.
+        duplicates = await ledger.recorded(keyed)
+        duplicates |= await applied_keys(keyed - duplicates)
+    increments: Dict[str, int] = {}
+    keyed_increments: Dict[str, Dict[str, int]] = {}
+    applied: Dict[int, PhotonEvent] = {}
+    accepted = iter(accepted_events)
+    for i, result in enumerate(results):
+        if not result["accepted"]:
+            continue
+        event = next(accepted)
+        key = event.idempotency_key
+        if key:
+            keys = keyed_increments.setdefault(event.email, {})
+            if (event.email, key) in duplicates or key in keys:
+                result["duplicate"] = True
+                continue
+        # Rate limited after the duplicate check, so retries are not charged.
+        if RATE_LIMIT_ENABLED:
+            wait = await earn_limiter.check(event.email, event.kind, event.amount)
+            if wait:
+                results[i] = {"accepted": False, "error": "rate limited", "retry_after": math.ceil(wait)}
+                continue
+        if key:
+            keys[key] = event.amount
+        else:
+            increments[event.email] = increments.get(event.email, 0) + event.amount
+        applied[i] = event
+
+    if applied:
+        keyed_increments = {email: keys for email, keys in keyed_increments.items() if keys}
+        try:
+            failed = await photon_coalescer.add(increments, keyed_increments, events=len(applied))
+        except Exception as e:
+            raise HTTPException(status_code=503, detail=f"Photon flush failed: {str(e)[:120]}")
+        for i, event in applied.items():
+            if event.email in failed:
+                results[i] = {"accepted": False, "error": "write failed, retry"}
+        await ledger.record([_ledger_entry(e) for i, e in applied.items()
+                             if e.idempotency_key and results[i]["accepted"]])
+        # The bulk flush returns no documents, so drop rather than write through.
+        for email in {e.email for e in applied.values()}:
+            profile_cache.invalidate(email)
+    return {"ok": True, "accepted": sum(r["accepted"] for r in results), "results": results}
 
 
 # ---------- Journal Endpoints (minimal) ----------
 
-@app.get("/api/journal", response_model=List[JournalPost])
-def list_journal():
-    docs = get_documents("journalpost")
-    for d in docs:
-        d.pop("_id", None)
-    return docs
+@app.get("/api/journal", response_model=Union[Page[JournalPost], List[JournalPost]])
+async def list_journal(request: Request, response: Response, page: PageParams = Depends()):
+    return await _list_page(request, response, "journal", "journalpost", {}, JOURNAL_ORDER, JournalPost, page)
 
 
 # ---------- Seed Minimal Content ----------
 
 @app.post("/api/seed")
-def seed_minimal():
+async def seed_minimal():
     """Insert a minimal set of sample products and lookbook entries if empty.
-    Safe to call multiple times; avoids duplicate slugs.
+    Safe to call multiple times; upserts only the seed slugs.
     """
-    inserted = {"products": 0, "lookbook": 0, "journal": 0}
-
-    # Products
-    existing_products = {p.get("slug") for p in get_documents("product")}
-    samples = [
-        Product(
-            title="Selene Sheath Dress",
-            slug="selene-sheath-dress",
-            description="A weightless satin silhouette with lunar drape.",
-            price=680.0,
-            category="Ready-to-Wear",
-            images=[
-                "https://images.unsplash.com/photo-1542060748-10c28b62716d?w=1400&q=80&auto=format&fit=crop"
-            ],
-            glb_url=None,
-            colorways=["Lunar Blush", "Eclipse Black"],
-            sizes=["XS", "S", "M", "L"],
-            co2_saved_kg=2.4,
-            in_stock=True,
-        ),
-        Product(
-            title="Nova Organza Gown",
-            slug="nova-organza-gown",
-            description="Ethereal organza with hand-finished moonsheen.",
-            price=1450.0,
-            category="Occasion",
-            images=[
-                "https://images.unsplash.com/photo-1520975954732-35dd226f1e9c?w=1400&q=80&auto=format&fit=crop"
-            ],
-            glb_url=None,
-            colorways=["Iridescent Pearl"],
-            sizes=["S", "M", "L"],
-            co2_saved_kg=5.1,
-            in_stock=True,
-        ),
-    ]
-    for p in samples:
-        if p.slug not in existing_products:
-            create_document("product", p)
-            inserted["products"] += 1
-
-    # Lookbook
-    existing_lb = {e.get("slug") for e in get_documents("lookbookentry")}
-    looks = [
-        LookbookEntry(
-            season="fall-24",
-            title="Moonrise Over Silk",
-            slug="moonrise-over-silk",
-            image="https://images.unsplash.com/photo-1503342394123-480259ab08e2?w=1400&q=80&auto=format&fit=crop",
-            product_slugs=["selene-sheath-dress"],
-            order=1,
-        )
-    ]
-    for lb in looks:
-        if lb.slug not in existing_lb:
-            create_document("lookbookentry", lb)
-            inserted["lookbook"] += 1
-
-    # Journal (optional minimal)
-    existing_posts = {j.get("slug") for j in get_documents("journalpost")}
-    posts = [
-        JournalPost(
-            title="On Weightless Femininity",
-            slug="on-weightless-femininity",
-            cover="https://images.unsplash.com/photo-1503342217505-b0a15cf70489?w=1400&q=80&auto=format&fit=crop",
-            content=None,
-        )
-    ]
-    for jp in posts:
-        if jp.slug not in existing_posts:
-            create_document("journalpost", jp)
-            inserted["journal"] += 1
-
+    counts = await load_fixtures(MINIMAL_FIXTURES)
+    for collection_name, count in counts.items():
+        if count:
+            invalidate_collection(collection_name)
+    inserted = {
+        "products": counts["product"],
+        "lookbook": counts["lookbookentry"],
+        "journal": counts["journalpost"],
+    }
     return {"ok": True, "inserted": inserted}
 
 
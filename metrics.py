@@ -0,0 +1,174 @@
+"""
+Prometheus Metrics
+
+Per-route request counts, latency and response-size histograms and an
+in-flight gauge (``MetricsMiddleware``), plus per-collection/per-command
+Mongo timings from pymongo command monitoring (``CommandMonitor``), rendered
+in the Prometheus text format by ``render()``.
+
+Request metrics are only touched from the event loop thread, so they are
+plain dict/list updates with no locking. Command events arrive on Motor's
+executor threads and go through a single short lock.
+"""
+
+import bisect
+import threading
+import time
+from typing import Dict, List, Sequence, Tuple
+
+from pymongo import monitoring
+
+import database
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (100, 1_000, 10_000, 100_000, 1_000_000, 10_000_000)
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, key: Tuple[str, ...] = (), amount: float = 1) -> None:
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, key, value
+
+
+class Gauge(Counter):
+    def set(self, key: Tuple[str, ...], value: float) -> None:
+        self.values[key] = value
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        # key -> [count per bucket (+Inf last)..., sum]
+        self.values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, key: Tuple[str, ...], value: float) -> None:
+        row = self.values.get(key)
+        if row is None:
+            row = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def samples(self):
+        for key, row in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), row[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket", key + (le,), cumulative
+            yield f"{self.name}_sum", key, row[-1]
+            yield f"{self.name}_count", key, cumulative
+
+
+http_requests = Counter("http_requests_total", "HTTP requests", ("method", "route", "status"))
+http_latency = Histogram("http_request_duration_seconds", "HTTP request latency", ("method", "route"))
+http_response_size = Histogram("http_response_size_bytes", "HTTP response body size", ("method", "route"),
+                               buckets=SIZE_BUCKETS)
+http_in_flight = Gauge("http_requests_in_flight", "HTTP requests currently being served")
+mongo_latency = Histogram("mongodb_command_duration_seconds", "Mongo command latency", ("collection", "command"))
+mongo_failures = Counter("mongodb_command_failures_total", "Failed Mongo commands", ("collection", "command"))
+
+REGISTRY = [http_requests, http_latency, http_response_size, http_in_flight, mongo_latency, mongo_failures]
+
+
+class MetricsMiddleware:
+    """Pure ASGI middleware; labels by route template, never by raw path"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+        size = 0
+
+        async def send_wrapper(message):
+            nonlocal status, size
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                size += len(message.get("body", b""))
+            await send(message)
+
+        http_in_flight.inc()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            http_in_flight.inc(amount=-1)
+            route = scope.get("route")
+            key = (scope["method"], getattr(route, "path", "unmatched"))
+            http_requests.inc(key + (str(status),))
+            http_latency.observe(key, time.perf_counter() - start)
+            http_response_size.observe(key, size)
+
+
+class CommandMonitor(monitoring.CommandListener):
+    """Times every Mongo command by collection and command name"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._started: Dict[Tuple, str] = {}
+
+    def started(self, event):
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            collection = "-"
+        with self._lock:
+            self._started[(event.connection_id, event.request_id)] = collection
+
+    def _finish(self, event, failed: bool):
+        with self._lock:
+            collection = self._started.pop((event.connection_id, event.request_id), "-")
+            key = (collection, event.command_name)
+            mongo_latency.observe(key, event.duration_micros / 1e6)
+            if failed:
+                mongo_failures.inc(key)
+
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+
+command_monitor = CommandMonitor()
+database.event_listeners.append(command_monitor)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format(metric_type: str, name: str, help: str, labels: Sequence[str], samples) -> List[str]:
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {metric_type}"]
+    for sample_name, key, value in samples:
+        names = labels + ("le",) if sample_name.endswith("_bucket") else labels
+        if names:
+            label_str = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, key))
+            lines.append(f"{sample_name}{{{label_str}}} {value}")
+        else:
+            lines.append(f"{sample_name} {value}")
+    return lines
+
+
+def render(extra_gauges: Dict[str, Tuple[str, float]] = None) -> str:
+    """Prometheus text exposition of every metric, plus ``{name: (help, value)}`` gauges"""
+    lines = []
+    with command_monitor._lock:
+        for metric in REGISTRY:
+            kind = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+            lines += _format(kind, metric.name, metric.help, metric.labels, list(metric.samples()))
+    for name, (help, value) in (extra_gauges or {}).items():
+        lines += _format("gauge", name, help, (), [(name, (), value)])
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,296 @@
+"""
+Photon Earning
+
+Update specs shared by the loyalty endpoints, plus a write coalescer that
+aggregates photon increments per email over a short window and flushes them
+to the ``loyaltyuser`` collection with a single unordered ``bulk_write``.
+
+Tiers follow the photon balance: every earn is a pipeline update that adds
+the photons and recomputes ``tier`` from the new balance in the same
+round trip. An earn carrying an idempotency key is deduplicated in that
+same update: each profile keeps its last ``IDEMPOTENCY_RECENT_KEYS`` keys in
+``recent_keys``, and a key already there adds nothing, so a retry after a
+timeout or a crash cannot credit twice. When thresholds change, re-tier the
+existing profiles with
+
+    TIER_THRESHOLDS="Lunar=1000,Eclipse=5000" python photons.py retier
+"""
+
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple, get_args
+
+from pymongo import UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from database import DATABASE_CONFIGURED, async_collection
+from schemas import LoyaltyUser
+
+TIER_NAMES = get_args(LoyaltyUser.model_fields["tier"].annotation)
+RECENT_KEYS = int(os.getenv("IDEMPOTENCY_RECENT_KEYS", "100"))
+
+
+def parse_thresholds(spec: str) -> List[Tuple[str, int]]:
+    """``"Lunar=1000,Eclipse=5000"`` -> ascending ``[("Nova", 0), ("Lunar", 1000), ...]``
+
+    Names must be ``LoyaltyUser.tier`` values other than the ``Nova`` floor,
+    each at most once; anything else would be written into profiles that
+    then fail validation on read.
+    """
+    tiers = [("Nova", 0)]
+    for item in filter(None, (s.strip() for s in spec.split(","))):
+        name, _, minimum = item.partition("=")
+        name = name.strip()
+        if name not in TIER_NAMES:
+            raise ValueError(f"Unknown tier {name!r} in thresholds; expected one of {TIER_NAMES[1:]}")
+        if name == "Nova":
+            raise ValueError("Nova is the 0-photon floor and cannot be given a threshold")
+        if any(name == existing for existing, _ in tiers):
+            raise ValueError(f"Tier {name!r} given more than once in thresholds")
+        tiers.append((name, int(minimum)))
+    return sorted(tiers, key=lambda t: t[1])
+
+
+TIERS = parse_thresholds(os.getenv("TIER_THRESHOLDS", "Lunar=1000,Eclipse=5000"))
+
+
+def tier_for(photons: int, tiers: Sequence[Tuple[str, int]] = TIERS) -> str:
+    for name, minimum in reversed(tiers):
+        if photons >= minimum:
+            return name
+    return tiers[0][0]
+
+
+def tier_expression(photons: str = "$photons", tiers: Sequence[Tuple[str, int]] = TIERS) -> dict:
+    """Aggregation expression mapping a photon balance to its tier name"""
+    branches = [{"case": {"$gte": [photons, minimum]}, "then": name} for name, minimum in reversed(tiers)]
+    return {"$switch": {"branches": branches, "default": tiers[0][0]}}
+
+
+def earn_update(amount: int, now: datetime = None, keyed: Optional[Dict[str, int]] = None) -> list:
+    """Upsert pipeline that atomically adds photons and re-derives ``tier``.
+
+    ``amount`` is added unconditionally; each ``{idempotency_key: amount}`` in
+    ``keyed`` is added only if the key is not yet in ``recent_keys``, and is
+    then appended to it (keeping the last ``RECENT_KEYS``).
+    """
+    now = now or datetime.now(timezone.utc)
+    added = [{"$ifNull": ["$photons", 0]}, int(amount)]
+    stage = {"created_at": {"$ifNull": ["$created_at", now]}, "updated_at": now}
+    if keyed:
+        recent = {"$ifNull": ["$recent_keys", []]}
+        added += [{"$cond": [{"$in": [{"$literal": key}, recent]}, 0, int(n)]} for key, n in keyed.items()]
+        fresh = {"$filter": {"input": {"$literal": list(keyed)}, "cond": {"$not": [{"$in": ["$$this", recent]}]}}}
+        stage["recent_keys"] = {"$slice": [{"$concatArrays": [recent, fresh]}, -RECENT_KEYS]}
+    return [
+        {"$set": {"photons": {"$add": added}, **stage}},
+        {"$set": {"tier": tier_expression("$photons")}},
+    ]
+
+
+async def applied_keys(pairs: Iterable[Tuple[str, str]]) -> Set[Tuple[str, str]]:
+    """The ``(email, idempotency_key)`` pairs still in their profile's ``recent_keys``,
+    i.e. the ones ``earn_update`` would skip"""
+    keys_by_email: Dict[str, Set[str]] = {}
+    for email, key in pairs:
+        keys_by_email.setdefault(email, set()).add(key)
+    if not keys_by_email:
+        return set()
+    found = await async_collection("loyaltyuser").find(
+        {"email": {"$in": list(keys_by_email)}, "recent_keys": {"$in": list(set().union(*keys_by_email.values()))}},
+        {"_id": 0, "email": 1, "recent_keys": 1},
+    ).to_list(length=None)
+    return {(d["email"], key) for d in found for key in keys_by_email[d["email"]].intersection(d["recent_keys"])}
+
+
+class PhotonCoalescer:
+    """Batch earn upserts per email; callers await the flush of their batch."""
+
+    def __init__(self, window: float = 0.05, max_pending: int = 1000):
+        self.window = window
+        self.max_pending = max_pending
+        self._pending: Dict[str, list] = {}  # email -> [amount, {idempotency_key: amount}]
+        self._waiters: List[asyncio.Future] = []
+        self._timer = None
+        self._inflight = set()
+        self.flushes = 0
+        self.flush_errors = 0
+        self.failed_emails = 0
+        self.events = 0
+        self.last_flush_size = 0
+        self.max_flush_size = 0
+        self.last_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+    async def add(self, increments: Dict[str, int], keyed: Optional[Dict[str, Dict[str, int]]] = None,
+                  events: int = 1) -> Set[str]:
+        """Queue ``{email: amount}`` and ``{email: {idempotency_key: amount}}``
+        increments and wait until they are written.
+
+        Returns the emails whose update failed (nothing was applied for them);
+        raises if the flush failed as a whole.
+        """
+        for email, amount in increments.items():
+            self._pending.setdefault(email, [0, {}])[0] += amount
+        for email, keys in (keyed or {}).items():
+            pending_keys = self._pending.setdefault(email, [0, {}])[1]
+            for key, amount in keys.items():
+                pending_keys.setdefault(key, amount)
+        self.events += events
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+
+        if len(self._pending) >= self.max_pending:
+            task = asyncio.create_task(self.flush())
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        return await waiter
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        pending, waiters = self._pending, self._waiters
+        self._pending, self._waiters = {}, []
+        if not pending:
+            for w in waiters:
+                if not w.done():
+                    w.set_result(set())
+            return
+
+        now = datetime.now(timezone.utc)
+        emails = list(pending)
+        ops = [UpdateOne({"email": email}, earn_update(amount, now, keys), upsert=True)
+               for email, (amount, keys) in pending.items()]
+        failed: Set[str] = set()
+        start = time.perf_counter()
+        try:
+            await async_collection("loyaltyuser").bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            # Unordered: every op without a write error was applied. A write
+            # concern error leaves that unknown, so it fails the whole flush.
+            self.flush_errors += 1
+            if e.details.get("writeConcernErrors"):
+                self._fail(waiters, e)
+                return
+            failed = {emails[err["index"]] for err in e.details.get("writeErrors", [])}
+            self.failed_emails += len(failed)
+        except Exception as e:
+            self.flush_errors += 1
+            self._fail(waiters, e)
+            return
+
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.flushes += 1
+        self.last_flush_ms = elapsed_ms
+        self.total_flush_ms += elapsed_ms
+        self.last_flush_size = len(ops)
+        self.max_flush_size = max(self.max_flush_size, len(ops))
+        for w in waiters:
+            if not w.done():
+                w.set_result(failed)
+
+    @staticmethod
+    def _fail(waiters: List[asyncio.Future], error: Exception) -> None:
+        for w in waiters:
+            if not w.done():
+                w.set_exception(error)
+
+    def stats(self) -> dict:
+        return {
+            "window_s": self.window,
+            "pending_emails": len(self._pending),
+            "events": self.events,
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "failed_emails": self.failed_emails,
+            "last_flush_size": self.last_flush_size,
+            "max_flush_size": self.max_flush_size,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+            "avg_flush_ms": round(self.total_flush_ms / self.flushes, 3) if self.flushes else 0.0,
+        }
+
+
+photon_coalescer = PhotonCoalescer(
+    window=float(os.getenv("PHOTON_FLUSH_WINDOW", "0.05")),
+    max_pending=int(os.getenv("PHOTON_FLUSH_MAX", "1000")),
+)
+
+
+# ---------- Re-tiering ----------
+
+async def retier_users(tiers: Sequence[Tuple[str, int]] = TIERS, batch_size: int = 10000,
+                       progress: Optional[Callable[[dict], None]] = None) -> dict:
+    """Bring every profile's ``tier`` in line with ``tiers``.
+
+    Walks ``loyaltyuser`` in ``_id`` order reading only ``_id`` (a covered
+    index scan) and, per batch, sends one unordered ``bulk_write`` with an
+    ``UpdateMany`` per tier band bounded to the batch's ``_id`` range, so
+    the server filters and rewrites only mismatched profiles. Safe to
+    re-run or resume: profiles already on the right tier are not touched.
+    """
+    collection = async_collection("loyaltyuser")
+    bands = []
+    for i, (name, minimum) in enumerate(tiers):
+        upper = tiers[i + 1][1] if i + 1 < len(tiers) else None
+        if i == 0:
+            # The lowest band also catches profiles with no photon balance.
+            bands.append((name, {"$not": {"$gte": upper}} if upper is not None else None))
+        else:
+            bands.append((name, {"$gte": minimum, "$lt": upper} if upper is not None else {"$gte": minimum}))
+    totals = {"scanned": 0, "modified": 0, "batches": 0}
+    start = time.perf_counter()
+    last_id = None
+    while True:
+        filt = {"_id": {"$gt": last_id}} if last_id is not None else {}
+        ids = await collection.find(filt, {"_id": 1}).sort("_id", 1).limit(batch_size).to_list(length=None)
+        if not ids:
+            break
+        first_id, last_id = ids[0]["_id"], ids[-1]["_id"]
+        now = datetime.now(timezone.utc)
+        ops = []
+        for name, photons in bands:
+            band = {"_id": {"$gte": first_id, "$lte": last_id}, "tier": {"$ne": name}}
+            if photons is not None:
+                band["photons"] = photons
+            ops.append(UpdateMany(band, {"$set": {"tier": name, "updated_at": now}}))
+        result = await collection.bulk_write(ops, ordered=False)
+        totals["scanned"] += len(ids)
+        totals["modified"] += result.modified_count
+        totals["batches"] += 1
+        elapsed = time.perf_counter() - start
+        totals["seconds"] = round(elapsed, 3)
+        totals["scanned_per_sec"] = round(totals["scanned"] / elapsed, 1)
+        if progress:
+            progress(dict(totals))
+    return totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("retier", help="recompute every profile's tier from TIER_THRESHOLDS")
+    p.add_argument("--thresholds", default=None, help='override TIER_THRESHOLDS, e.g. "Lunar=800,Eclipse=4000"')
+    p.add_argument("--batch-size", type=int, default=10000)
+    args = parser.parse_args()
+    if not DATABASE_CONFIGURED:
+        parser.error("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    try:
+        tiers = parse_thresholds(args.thresholds) if args.thresholds is not None else TIERS
+    except ValueError as e:
+        parser.error(str(e))
+    print("tiers:", tiers)
+    totals = asyncio.run(retier_users(tiers, args.batch_size, progress=lambda t: print(t, flush=True)))
+    print(totals)
+
+
+if __name__ == "__main__":
+    main()
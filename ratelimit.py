@@ -0,0 +1,213 @@
+"""
+Earn Rate Limiting
+
+Token buckets checked before an earn touches Mongo: one bucket of events per
+``(email, kind)`` and one bucket of photons per email (an event costs its
+``amount``), so neither rapid-fire events nor oversized amounts can farm
+photons.
+
+Buckets live in a bounded LRU (``RATE_LIMIT_MAX_KEYS``); evicting an idle
+bucket only forgets a key that has been refilling anyway. Limits are per
+worker process. With ``RATE_LIMIT_REDIS_URL`` set (and the ``redis`` package
+installed) the buckets are kept in Redis instead so every worker shares
+them; if Redis errors, checks fall back to the local buckets.
+
+    EARN_RATE_LIMIT_EVENTS="30/60"     # 30 events per minute per email+kind
+    EARN_RATE_LIMIT_PHOTONS="500/3600" # 500 photons per hour per email
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+
+
+def parse_limit(spec: str) -> Tuple[float, float]:
+    """``"30/60"`` (30 per 60 seconds) -> ``(rate per second, burst)``"""
+    amount, _, seconds = spec.partition("/")
+    burst, seconds = float(amount), float(seconds or 1)
+    if burst <= 0 or seconds <= 0:
+        # A zero rate never refills: every rejection would wait forever.
+        raise ValueError(f"rate limit {spec!r} must be a positive amount per positive number of seconds")
+    return burst / seconds, burst
+
+
+class TokenBucket:
+    """Per-key token buckets (``rate`` tokens/s up to ``burst``) in a bounded LRU"""
+
+    def __init__(self, rate: float, burst: float, maxsize: int = 100_000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets: "OrderedDict[Hashable, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = 0
+        self.evictions = 0
+
+    def check(self, key: Hashable, cost: float = 1.0, now: Optional[float] = None) -> float:
+        """Take ``cost`` tokens; returns 0.0 if allowed, else seconds until it would be"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+                if len(self._buckets) > self.maxsize:
+                    self._buckets.popitem(last=False)
+                    self.evictions += 1
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                self.allowed += 1
+                return 0.0
+            self.rejected += 1
+            return (cost - bucket[0]) / self.rate if self.rate else float("inf")
+
+    def refund(self, key: Hashable, cost: float = 1.0) -> None:
+        """Give back tokens taken by a check whose event was then rejected elsewhere"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + cost)
+
+    def stats(self) -> dict:
+        return {
+            "rate_per_s": self.rate,
+            "burst": self.burst,
+            "keys": len(self._buckets),
+            "maxsize": self.maxsize,
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "evictions": self.evictions,
+        }
+
+
+# Atomic token bucket on a Redis hash, using the server clock so workers on
+# different hosts agree. Returns "0" if allowed, else the wait in seconds.
+_REDIS_BUCKET = """
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(b[1]) or burst
+local ts = tonumber(b[2]) or now
+tokens = math.min(burst, tokens + (now - ts) * rate)
+local wait = 0
+if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(burst / rate * 1000))
+return tostring(wait)
+"""
+
+
+# Give tokens back, capped at the burst; a bucket that has expired is already full.
+_REDIS_REFUND = """
+local burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2])
+local tokens = tonumber(redis.call('HGET', KEYS[1], 'tokens'))
+if tokens then redis.call('HSET', KEYS[1], 'tokens', math.min(burst, tokens + cost)) end
+return 0
+"""
+
+
+class RedisTokenBucket:
+    """Same contract as ``TokenBucket.check`` but shared through Redis"""
+
+    def __init__(self, client, prefix: str, rate: float, burst: float):
+        self.prefix = prefix
+        self.rate = rate
+        self.burst = burst
+        self._script = client.register_script(_REDIS_BUCKET)
+        self._refund = client.register_script(_REDIS_REFUND)
+
+    def _key(self, key: Tuple[str, ...]) -> str:
+        return ":".join((self.prefix,) + key)
+
+    async def check(self, key: Tuple[str, ...], cost: float = 1.0) -> float:
+        wait = await self._script(keys=[self._key(key)], args=[self.rate, self.burst, cost])
+        return float(wait)
+
+    async def refund(self, key: Tuple[str, ...], cost: float = 1.0) -> None:
+        await self._refund(keys=[self._key(key)], args=[self.burst, cost])
+
+
+def _redis_client():
+    url = os.getenv("RATE_LIMIT_REDIS_URL")
+    if not url:
+        return None
+    try:
+        import redis.asyncio
+    except ImportError:
+        logger.warning("RATE_LIMIT_REDIS_URL is set but the redis package is not installed; limits are per worker")
+        return None
+    return redis.asyncio.from_url(url)
+
+
+class EarnLimiter:
+    """Events per (email, kind) and photons per email, local or Redis-backed"""
+
+    def __init__(self, events: Tuple[float, float], photons: Tuple[float, float], maxsize: int = 100_000,
+                 redis_client=None):
+        self.events = TokenBucket(*events, maxsize=maxsize)
+        self.photons = TokenBucket(*photons, maxsize=maxsize)
+        self.shared = None
+        if redis_client is not None:
+            self.shared = (RedisTokenBucket(redis_client, "rl:earn:events", *events),
+                           RedisTokenBucket(redis_client, "rl:earn:photons", *photons))
+        self.shared_errors = 0
+
+    @property
+    def max_amount(self) -> float:
+        """Largest single earn that can ever pass: a full photon bucket"""
+        return self.photons.burst
+
+    def check_local(self, email: str, kind: str, amount: int) -> float:
+        wait = self.events.check((email, kind))
+        if wait:
+            return wait
+        wait = self.photons.check((email,), amount)
+        if wait:
+            self.events.refund((email, kind))
+        return wait
+
+    async def check(self, email: str, kind: str, amount: int) -> float:
+        """0.0 if the event may proceed, else seconds the client should wait"""
+        if self.shared is None:
+            return self.check_local(email, kind, amount)
+        try:
+            wait = await self.shared[0].check((email, kind))
+            if wait:
+                return wait
+            wait = await self.shared[1].check((email,), amount)
+            if wait:
+                await self.shared[0].refund((email, kind))
+            return wait
+        except Exception as e:
+            self.shared_errors += 1
+            logger.warning("Shared rate limit check failed, using local buckets: %s", e)
+            return self.check_local(email, kind, amount)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": RATE_LIMIT_ENABLED,
+            "backend": "redis" if self.shared else "local",
+            "shared_errors": self.shared_errors,
+            "events": self.events.stats(),
+            "photons": self.photons.stats(),
+        }
+
+
+earn_limiter = EarnLimiter(
+    events=parse_limit(os.getenv("EARN_RATE_LIMIT_EVENTS", "30/60")),
+    photons=parse_limit(os.getenv("EARN_RATE_LIMIT_PHOTONS", "500/3600")),
+    maxsize=int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000")),
+    redis_client=_redis_client(),
+)
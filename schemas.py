@@ -5,7 +5,10 @@ Each Pydantic model represents a collection in MongoDB.
 Collection name is the lowercase of the class name.
 """
 
+import os
+
 from pydantic import BaseModel, Field
+from pymongo import ASCENDING, TEXT, IndexModel
 from typing import Optional, List, Literal
 
 
@@ -50,9 +53,49 @@ class LoyaltyUser(BaseModel):
     tier: Literal["Nova", "Lunar", "Eclipse"] = "Nova"
 
 
+class PhotonEvent(BaseModel):
+    """
+    Photon earn event; keyed events are kept in an append-only ledger
+    Collection: "photonevent"
+    """
+    email: str
+    kind: str  # view_3d, share_ar, recycle
+    amount: int = 5
+    idempotency_key: Optional[str] = Field(None, max_length=128, description="Client retry key")
+
+
 # Minimal Journal schema if needed later
 class JournalPost(BaseModel):
     title: str
     slug: str
     cover: str
     content: Optional[str] = None
+
+
+# Indexes backing every hot query in main.py, keyed by collection name.
+# Ensured idempotently on startup (see database.ensure_indexes_async).
+INDEXES = {
+    "product": [
+        IndexModel([("slug", ASCENDING)], name="slug_unique", unique=True),
+        IndexModel([("category", ASCENDING), ("slug", ASCENDING)], name="category_slug"),
+        IndexModel([("title", TEXT), ("description", TEXT)], name="title_description_text",
+                   weights={"title": 5, "description": 1}),
+    ],
+    "lookbookentry": [
+        IndexModel([("season", ASCENDING), ("order", ASCENDING), ("slug", ASCENDING)], name="season_order_slug"),
+        IndexModel([("slug", ASCENDING)], name="slug_unique", unique=True),
+    ],
+    "loyaltyuser": [
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True),
+    ],
+    "photonevent": [
+        IndexModel([("email", ASCENDING), ("idempotency_key", ASCENDING)], name="email_idempotency_key_unique",
+                   unique=True),
+        # Changing IDEMPOTENCY_TTL later needs a collMod; create_indexes will not alter it.
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl",
+                   expireAfterSeconds=int(os.getenv("IDEMPOTENCY_TTL", "86400"))),
+    ],
+    "journalpost": [
+        IndexModel([("slug", ASCENDING)], name="slug_unique", unique=True),
+    ],
+}
@@ -0,0 +1,371 @@
+"""
+Product Search
+
+Text search with facet filters on colorways, sizes, stock, price and CO2
+saved, returning the page of items, the total and the facet counts together.
+Facets are disjunctive: each facet's counts apply every active filter except
+its own, so selecting a colorway still shows how many products the other
+colorways would match.
+
+With the catalog snapshot loaded (``CATALOG_SNAPSHOT=1``) searches are
+answered from memory by the snapshot's ``SearchIndex``: text terms go through
+the postings of a ``suggest.ProductIndex`` over the same products (title,
+description, category and colorways; a product matches any term and ranks by
+how many it matches), and every filter and facet value is a bitset, so a
+search is a few dozen big-int ANDs and ``bit_count`` calls whatever the match
+size. Measure with ``python benchmark.py search --products 50000``.
+
+Without the snapshot, one ``$facet`` aggregation over the Mongo text index
+answers the search, cached in the catalog cache until the product collection
+is invalidated.
+"""
+
+import bisect
+import json
+import sys
+from array import array
+from typing import Dict, Hashable, Iterable, List, Optional, Sequence, Tuple
+
+from cache import _query_key, catalog_cache, content_etag
+from database import async_collection, model_projection
+from schemas import Product
+from suggest import ProductIndex, tokenize
+
+# (lower, upper) bounds per range facet; upper=None is open-ended
+PRICE_RANGES = [(0, 100), (100, 250), (250, 500), (500, 1000), (1000, 2500), (2500, None)]
+CO2_RANGES = [(0, 1), (1, 2.5), (2.5, 5), (5, None)]
+
+SORTS = {
+    "relevance": [("_score", -1), ("slug", 1)],
+    "slug": [("slug", 1)],
+    "price_asc": [("price", 1), ("slug", 1)],
+    "price_desc": [("price", -1), ("slug", 1)],
+}
+
+_PROJECTION = model_projection(Product)
+
+
+def _range_label(lower: float, upper: Optional[float]) -> str:
+    return f"{lower:g}+" if upper is None else f"{lower:g}-{upper:g}"
+
+
+def _range_facet(field: str, ranges: Sequence[Tuple[float, Optional[float]]]) -> List[dict]:
+    branches = []
+    for lower, upper in ranges:
+        cond = [{"$gte": [f"${field}", lower]}]
+        if upper is not None:
+            cond.append({"$lt": [f"${field}", upper]})
+        branches.append({"case": {"$and": cond}, "then": _range_label(lower, upper)})
+    return [
+        {"$group": {"_id": {"$switch": {"branches": branches, "default": None}}, "count": {"$sum": 1}}},
+        {"$match": {"_id": {"$ne": None}}},
+    ]
+
+
+def _bounds(low: Optional[float], high: Optional[float]) -> Optional[dict]:
+    cond = {}
+    if low is not None:
+        cond["$gte"] = low
+    if high is not None:
+        cond["$lte"] = high
+    return cond or None
+
+
+def build_pipeline(q: Optional[str] = None, category: Optional[str] = None, colorways: Sequence[str] = (),
+                   sizes: Sequence[str] = (), in_stock: Optional[bool] = None, price_min: float = None,
+                   price_max: float = None, co2_min: float = None, co2_max: float = None,
+                   sort: str = "relevance", offset: int = 0, limit: int = 50) -> List[dict]:
+    """Aggregation pipeline producing ``{items, total, facets...}`` in one document"""
+    base: Dict = {}
+    if q:
+        base["$text"] = {"$search": q}
+    if category:
+        base["category"] = category
+
+    # Filters per facet, so each facet branch can leave its own one out.
+    filters = {
+        "colorways": {"colorways": {"$in": list(colorways)}} if colorways else None,
+        "sizes": {"sizes": {"$in": list(sizes)}} if sizes else None,
+        "in_stock": {"in_stock": in_stock} if in_stock is not None else None,
+        "price": {"price": _bounds(price_min, price_max)} if _bounds(price_min, price_max) else None,
+        "co2_saved_kg": {"co2_saved_kg": _bounds(co2_min, co2_max)} if _bounds(co2_min, co2_max) else None,
+    }
+
+    def match(exclude: Optional[str] = None) -> List[dict]:
+        active = [f for name, f in filters.items() if f is not None and name != exclude]
+        return [{"$match": {"$and": active}}] if active else []
+
+    if not q and sort == "relevance":
+        sort = "slug"
+    facets = {
+        "items": match() + [{"$sort": dict(SORTS[sort])}, {"$skip": offset}, {"$limit": limit},
+                            {"$project": _PROJECTION}],
+        "total": match() + [{"$count": "n"}],
+        "colorways": match("colorways") + [{"$unwind": "$colorways"}, {"$sortByCount": "$colorways"}],
+        "sizes": match("sizes") + [{"$unwind": "$sizes"}, {"$sortByCount": "$sizes"}],
+        "in_stock": match("in_stock") + [{"$sortByCount": "$in_stock"}],
+        "price": match("price") + _range_facet("price", PRICE_RANGES),
+        "co2_saved_kg": match("co2_saved_kg") + _range_facet("co2_saved_kg", CO2_RANGES),
+    }
+    pipeline = [{"$match": base}] if base else []
+    if q:
+        pipeline.append({"$addFields": {"_score": {"$meta": "textScore"}}})
+    pipeline.append({"$facet": facets})
+    return pipeline
+
+
+def _shape(raw: dict, ranges: Dict[str, Sequence]) -> dict:
+    facets = {}
+    for name in ("colorways", "sizes", "in_stock"):
+        facets[name] = [{"value": row["_id"], "count": row["count"]} for row in raw[name]]
+    for name, bounds in ranges.items():
+        counts = {row["_id"]: row["count"] for row in raw[name]}
+        labels = [_range_label(lower, upper) for lower, upper in bounds]
+        facets[name] = [{"value": label, "count": counts.get(label, 0)} for label in labels]
+    return {
+        "items": raw["items"],
+        "total": raw["total"][0]["n"] if raw["total"] else 0,
+        "facets": facets,
+    }
+
+
+async def search_products(**params) -> Tuple[dict, str]:
+    """Run (or reuse) a search; returns ``(result, etag)``. See ``build_pipeline`` for params"""
+    key = _query_key("product", "search", params)
+    entry = catalog_cache.get(key)
+    if entry is None:
+        raw = await async_collection("product").aggregate(build_pipeline(**params)).to_list(length=1)
+        result = _shape(raw[0], {"price": PRICE_RANGES, "co2_saved_kg": CO2_RANGES})
+        entry = (result, content_etag([result]))
+        catalog_cache.set(key, entry)
+    return entry
+
+
+# ---------- In-memory search over the catalog snapshot ----------
+
+# Postings at least this long keep their bitset once built; shorter ones are cheap to rebuild.
+CACHED_POSTING = 256
+MAX_QUERY_TERMS = 16
+_RANGE_BLOCK = 512
+
+
+def _bitset(ids: Iterable[int], size: int) -> int:
+    """Bitset (bit i = doc i) of ``ids`` among ``size`` docs"""
+    bits = bytearray((size + 7) // 8)
+    for i in ids:
+        bits[i >> 3] |= 1 << (i & 7)
+    return int.from_bytes(bits, "little")
+
+
+def _value_bitsets(values: Iterable[Iterable[Hashable]], size: int) -> Dict[Hashable, int]:
+    ids: Dict[Hashable, List[int]] = {}
+    for i, doc_values in enumerate(values):
+        for value in doc_values:
+            ids.setdefault(value, []).append(i)
+    return {value: _bitset(doc_ids, size) for value, doc_ids in ids.items()}
+
+
+def _ids(bitset: int, size: int, skip: int = 0, limit: Optional[int] = None) -> List[int]:
+    """Doc ids set in ``bitset``, ascending, after skipping ``skip`` of them"""
+    words = array("Q", bitset.to_bytes((size + 63) // 64 * 8, "little"))
+    if sys.byteorder == "big":
+        words.byteswap()
+    found = []
+    for w, word in enumerate(words):
+        if not word:
+            continue
+        if skip:
+            n = word.bit_count()
+            if skip >= n:
+                skip -= n
+                continue
+        while word:
+            low = word & -word
+            word ^= low
+            if skip:
+                skip -= 1
+                continue
+            found.append(w * 64 + low.bit_length() - 1)
+            if len(found) == limit:
+                return found
+    return found
+
+
+class _RangeIndex:
+    """Docs ordered by one numeric field, with prefix bitsets every ``_RANGE_BLOCK`` docs"""
+
+    def __init__(self, values: Sequence[Optional[float]]):
+        self.size = len(values)
+        pairs = sorted((v, i) for i, v in enumerate(values) if v is not None)
+        self.keys = [v for v, _ in pairs]
+        self.order = [i for _, i in pairs]  # ascending value, then slug
+        self.order_desc = [i for _, i in sorted((-v, i) for v, i in pairs)]  # descending value, then slug
+        self.rank = self._ranks(self.order)
+        self.rank_desc = self._ranks(self.order_desc)
+        bits = bytearray((self.size + 7) // 8)
+        self.prefix = [0]
+        for start in range(0, len(self.order), _RANGE_BLOCK):
+            for i in self.order[start:start + _RANGE_BLOCK]:
+                bits[i >> 3] |= 1 << (i & 7)
+            self.prefix.append(int.from_bytes(bits, "little"))
+
+    def _ranks(self, order: List[int]) -> List[int]:
+        rank = [len(order)] * self.size  # docs without a value sort last
+        for r, i in enumerate(order):
+            rank[i] = r
+        return rank
+
+    def _below(self, pos: int) -> int:
+        block = pos // _RANGE_BLOCK
+        rest = self.order[block * _RANGE_BLOCK:pos]
+        return self.prefix[block] | _bitset(rest, self.size) if rest else self.prefix[block]
+
+    def between(self, low: Optional[float] = None, high: Optional[float] = None, high_inclusive: bool = True) -> int:
+        """Docs with ``low <= value <= high`` (``< high`` unless ``high_inclusive``)"""
+        start = bisect.bisect_left(self.keys, low) if low is not None else 0
+        if high is None:
+            end = len(self.keys)
+        else:
+            end = (bisect.bisect_right if high_inclusive else bisect.bisect_left)(self.keys, high)
+        if end <= start:
+            return 0
+        return self._below(end) & ~self._below(start)
+
+
+class SearchIndex:
+    """Bitset facets plus text postings over one immutable list of products.
+
+    Doc ids are positions in ``products``, which are in slug order, so id
+    order is the ``slug`` sort and the tie-break of every other sort.
+    """
+
+    def __init__(self, products: Sequence[Product], items: Sequence[bytes]):
+        self.size = len(products)
+        self.items = items
+        self.text = ProductIndex(completions=False)
+        for product in products:
+            self.text.add(product)
+        if len(self.text) != self.size:
+            raise ValueError("Duplicate product slugs; search ids would not line up")
+        self.all = (1 << self.size) - 1
+        self.category = _value_bitsets(((p.category,) for p in products), self.size)
+        self.colorways = _value_bitsets((p.colorways for p in products), self.size)
+        self.sizes = _value_bitsets((p.sizes for p in products), self.size)
+        self.in_stock = _value_bitsets(((p.in_stock,) for p in products), self.size)
+        self.price = _RangeIndex([p.price for p in products])
+        self.co2 = _RangeIndex([p.co2_saved_kg for p in products])
+        self.ranges = {
+            "price": [(_range_label(lo, hi), self.price.between(lo, hi, False)) for lo, hi in PRICE_RANGES],
+            "co2_saved_kg": [(_range_label(lo, hi), self.co2.between(lo, hi, False)) for lo, hi in CO2_RANGES],
+        }
+        self._postings: Dict[str, int] = {}
+
+    def _term(self, token: str) -> int:
+        bitset = self._postings.get(token)
+        if bitset is None:
+            posting = self.text.postings.get(token)
+            if not posting:
+                return 0
+            bitset = _bitset(posting, self.size)
+            if len(posting) >= CACHED_POSTING:
+                self._postings[token] = bitset
+        return bitset
+
+    def _any_of(self, bitsets: Dict[Hashable, int], values: Sequence[Hashable]) -> int:
+        found = 0
+        for value in values:
+            found |= bitsets.get(value, 0)
+        return found
+
+    def _relevance_ids(self, matched: int, terms: List[int], skip: int, limit: int) -> List[int]:
+        """Page of ``matched`` ranked by how many ``terms`` each doc contains"""
+        at_least = [self.all] + [0] * len(terms)
+        for term in terms:
+            for k in range(len(terms), 0, -1):
+                at_least[k] |= at_least[k - 1] & term
+        ids = []
+        for k in range(len(terms), 0, -1):
+            level = matched & at_least[k] & ~(at_least[k + 1] if k < len(terms) else 0)
+            n = level.bit_count()
+            if skip >= n:
+                skip -= n
+                continue
+            ids += _ids(level, self.size, skip, limit - len(ids))
+            skip = 0
+            if len(ids) == limit:
+                break
+        return ids
+
+    def _sorted_ids(self, matched: int, count: int, descending: bool, skip: int, limit: int) -> List[int]:
+        """Page of ``matched`` by price (then slug)"""
+        prices = self.price
+        order, rank = (prices.order_desc, prices.rank_desc) if descending else (prices.order, prices.rank)
+        if count * 32 <= self.size:
+            # Sparse: sorting the matches beats scanning the whole price order.
+            return sorted(_ids(matched, self.size), key=rank.__getitem__)[skip:skip + limit]
+        bits = matched.to_bytes((self.size + 7) // 8, "little")
+        ids = []
+        for i in order:
+            if bits[i >> 3] >> (i & 7) & 1:
+                if skip:
+                    skip -= 1
+                    continue
+                ids.append(i)
+                if len(ids) == limit:
+                    break
+        return ids
+
+    def search(self, q: Optional[str] = None, category: Optional[str] = None, colorways: Sequence[str] = (),
+               sizes: Sequence[str] = (), in_stock: Optional[bool] = None, price_min: float = None,
+               price_max: float = None, co2_min: float = None, co2_max: float = None,
+               sort: str = "relevance", offset: int = 0, limit: int = 50) -> bytes:
+        """``{items, total, facets}`` JSON bytes; same parameters and shape as ``build_pipeline``"""
+        base = self.all
+        terms: List[int] = []
+        if q:
+            tokens = list(dict.fromkeys(tokenize(q)))[:MAX_QUERY_TERMS]
+            terms = [t for t in map(self._term, tokens) if t]
+            base = 0
+            for term in terms:
+                base |= term
+        if category:
+            base &= self.category.get(category, 0)
+
+        filters = {
+            "colorways": self._any_of(self.colorways, colorways) if colorways else None,
+            "sizes": self._any_of(self.sizes, sizes) if sizes else None,
+            "in_stock": self.in_stock.get(in_stock, 0) if in_stock is not None else None,
+            "price": self.price.between(price_min, price_max) if _bounds(price_min, price_max) else None,
+            "co2_saved_kg": self.co2.between(co2_min, co2_max) if _bounds(co2_min, co2_max) else None,
+        }
+
+        def match(exclude: Optional[str] = None) -> int:
+            bitset = base
+            for name, f in filters.items():
+                if f is not None and name != exclude:
+                    bitset &= f
+            return bitset
+
+        matched = match()
+        total = matched.bit_count()
+        if not q and sort == "relevance":
+            sort = "slug"
+        if sort == "relevance":
+            ids = self._relevance_ids(matched, terms, offset, limit)
+        elif sort == "slug":
+            ids = _ids(matched, self.size, offset, limit)
+        else:
+            ids = self._sorted_ids(matched, total, sort == "price_desc", offset, limit)
+
+        facets = {}
+        for name, bitsets in (("colorways", self.colorways), ("sizes", self.sizes), ("in_stock", self.in_stock)):
+            within = match(name)
+            counts = [(value, (within & bitset).bit_count()) for value, bitset in bitsets.items()]
+            counts.sort(key=lambda vc: (-vc[1], str(vc[0])))
+            facets[name] = [{"value": value, "count": n} for value, n in counts if n]
+        for name, buckets in self.ranges.items():
+            within = match(name)
+            facets[name] = [{"value": label, "count": (within & bitset).bit_count()} for label, bitset in buckets]
+
+        return (b'{"items":[' + b",".join(self.items[i] for i in ids) + b'],"total":' + str(total).encode()
+                + b',"facets":' + json.dumps(facets, separators=(",", ":")).encode() + b"}")
@@ -0,0 +1,194 @@
+"""
+Seed Fixtures
+
+Idempotent fixture loading: every document is written as a ``$setOnInsert``
+upsert keyed on its natural key (slug, or email for loyalty users), one
+``bulk_write`` per batch, so seeding only ever touches the seed keys and
+never rewrites existing data. The same loader streams large generated
+datasets for benchmarking:
+
+    python seed.py                                   # minimal sample content
+    python seed.py --products 50000 --lookbook 5000 --journal 1000 --users 100000
+"""
+
+import argparse
+import asyncio
+import itertools
+from datetime import datetime, timezone
+from typing import Dict, Iterable, Iterator, Union
+
+from pydantic import BaseModel
+from pymongo import UpdateOne
+
+from database import DATABASE_CONFIGURED, async_collection
+from photons import tier_for
+from schemas import JournalPost, LookbookEntry, Product
+
+# Natural key per collection, backed by the unique indexes in schemas.INDEXES
+FIXTURE_KEYS = {"product": "slug", "lookbookentry": "slug", "journalpost": "slug", "loyaltyuser": "email"}
+
+MINIMAL_FIXTURES = {
+    "product": [
+        Product(
+            title="Selene Sheath Dress",
+            slug="selene-sheath-dress",
+            description="A weightless satin silhouette with lunar drape.",
+            price=680.0,
+            category="Ready-to-Wear",
+            images=[
+                "https://images.unsplash.com/photo-1542060748-10c28b62716d?w=1400&q=80&auto=format&fit=crop"
+            ],
+            glb_url=None,
+            colorways=["Lunar Blush", "Eclipse Black"],
+            sizes=["XS", "S", "M", "L"],
+            co2_saved_kg=2.4,
+            in_stock=True,
+        ),
+        Product(
+            title="Nova Organza Gown",
+            slug="nova-organza-gown",
+            description="Ethereal organza with hand-finished moonsheen.",
+            price=1450.0,
+            category="Occasion",
+            images=[
+                "https://images.unsplash.com/photo-1520975954732-35dd226f1e9c?w=1400&q=80&auto=format&fit=crop"
+            ],
+            glb_url=None,
+            colorways=["Iridescent Pearl"],
+            sizes=["S", "M", "L"],
+            co2_saved_kg=5.1,
+            in_stock=True,
+        ),
+    ],
+    "lookbookentry": [
+        LookbookEntry(
+            season="fall-24",
+            title="Moonrise Over Silk",
+            slug="moonrise-over-silk",
+            image="https://images.unsplash.com/photo-1503342394123-480259ab08e2?w=1400&q=80&auto=format&fit=crop",
+            product_slugs=["selene-sheath-dress"],
+            order=1,
+        )
+    ],
+    "journalpost": [
+        JournalPost(
+            title="On Weightless Femininity",
+            slug="on-weightless-femininity",
+            cover="https://images.unsplash.com/photo-1503342217505-b0a15cf70489?w=1400&q=80&auto=format&fit=crop",
+            content=None,
+        )
+    ],
+}
+
+
+async def load_fixtures(fixtures: Dict[str, Iterable[Union[BaseModel, dict]]],
+                        batch_size: int = 1000) -> Dict[str, int]:
+    """Insert fixtures whose key is not present yet; returns inserted counts per collection"""
+    inserted = {}
+    for collection_name, items in fixtures.items():
+        key = FIXTURE_KEYS[collection_name]
+        inserted[collection_name] = 0
+        items = iter(items)
+        while True:
+            batch = list(itertools.islice(items, batch_size))
+            if not batch:
+                break
+            now = datetime.now(timezone.utc)
+            ops = []
+            for item in batch:
+                doc = item.model_dump() if isinstance(item, BaseModel) else dict(item)
+                doc["created_at"] = doc["updated_at"] = now
+                ops.append(UpdateOne({key: doc[key]}, {"$setOnInsert": doc}, upsert=True))
+            result = await async_collection(collection_name).bulk_write(ops, ordered=False)
+            inserted[collection_name] += result.upserted_count
+    return inserted
+
+
+# ---------- Generated datasets ----------
+
+CATEGORIES = ["New", "Ready-to-Wear", "Occasion", "Atelier"]
+COLORWAYS = ["Lunar Blush", "Eclipse Black", "Iridescent Pearl", "Nebula Violet", "Solar Gold", "Tidal Silver"]
+NOUNS = ["Dress", "Gown", "Blazer", "Skirt", "Coat", "Blouse", "Trouser", "Cape", "Slip", "Corset"]
+ADJECTIVES = ["Selene", "Nova", "Lunar", "Eclipse", "Orbit", "Aurora", "Nebula", "Comet", "Zenith", "Halo"]
+
+
+def generate_products(count: int, prefix: str = "gen") -> Iterator[dict]:
+    for i in range(count):
+        adjective, noun = ADJECTIVES[i % len(ADJECTIVES)], NOUNS[(i // len(ADJECTIVES)) % len(NOUNS)]
+        # Second colorway 1..5 places after the first, so the pair never repeats a colorway.
+        second = (i + 1 + (i // len(COLORWAYS)) % (len(COLORWAYS) - 1)) % len(COLORWAYS)
+        yield {
+            "title": f"{adjective} {noun} {i}",
+            "slug": f"{prefix}-{i:07d}",
+            "description": f"A {adjective.lower()} {noun.lower()} cut from moon-washed satin, piece {i}.",
+            "price": float(90 + (i * 37) % 2400),
+            "category": CATEGORIES[i % len(CATEGORIES)],
+            "images": [f"https://img.example/{prefix}/{i}.jpg"],
+            "glb_url": None,
+            "colorways": [COLORWAYS[i % len(COLORWAYS)], COLORWAYS[second]],
+            "sizes": ["XS", "S", "M", "L", "XL"][: 2 + i % 4],
+            "co2_saved_kg": round((i % 60) / 10, 1),
+            "in_stock": i % 5 != 0,
+        }
+
+
+def generate_lookbook(count: int, prefix: str = "gen", seasons: int = 8, product_prefix: str = "gen",
+                      products: int = 1) -> Iterator[dict]:
+    for i in range(count):
+        yield {
+            "season": f"{prefix}-season-{i % seasons}",
+            "title": f"Look {i}",
+            "slug": f"{prefix}-look-{i:07d}",
+            "image": f"https://img.example/{prefix}/look-{i}.jpg",
+            "product_slugs": [f"{product_prefix}-{(i * 13) % max(products, 1):07d}"],
+            "order": i // seasons,
+        }
+
+
+def generate_journal(count: int, prefix: str = "gen") -> Iterator[dict]:
+    for i in range(count):
+        yield {
+            "title": f"Journal Entry {i}",
+            "slug": f"{prefix}-post-{i:07d}",
+            "cover": f"https://img.example/{prefix}/post-{i}.jpg",
+            "content": "Notes from the atelier. " * 20,
+        }
+
+
+def generate_users(count: int, prefix: str = "gen") -> Iterator[dict]:
+    for i in range(count):
+        photons = (i * 31) % 6000
+        yield {"email": f"{prefix}-{i:07d}@example.com", "photons": photons, "tier": tier_for(photons)}
+
+
+def generated_fixtures(products: int = 0, lookbook: int = 0, journal: int = 0, users: int = 0,
+                       prefix: str = "gen") -> Dict[str, Iterator[dict]]:
+    return {
+        "product": generate_products(products, prefix),
+        "lookbookentry": generate_lookbook(lookbook, prefix, product_prefix=prefix, products=products),
+        "journalpost": generate_journal(journal, prefix),
+        "loyaltyuser": generate_users(users, prefix),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=0)
+    parser.add_argument("--lookbook", type=int, default=0)
+    parser.add_argument("--journal", type=int, default=0)
+    parser.add_argument("--users", type=int, default=0)
+    parser.add_argument("--prefix", default="gen")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    if not DATABASE_CONFIGURED:
+        parser.error("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    if any((args.products, args.lookbook, args.journal, args.users)):
+        fixtures = generated_fixtures(args.products, args.lookbook, args.journal, args.users, args.prefix)
+    else:
+        fixtures = MINIMAL_FIXTURES
+    print(asyncio.run(load_fixtures(fixtures, args.batch_size)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Production Launcher
+
+Pre-forking server for the API: the master imports ``main`` once, binds the
+listening socket and forks N uvicorn workers that share both, so code pages
+are shared copy-on-write and every worker accepts on the same port.
+
+    python serve.py                   # production: one worker per CPU
+    python serve.py --workers 4       # fixed worker count
+    python serve.py --dev             # single process with --reload
+
+Signals (master): SIGHUP reloads code and environment by re-executing the
+master in place (same pid, same listening socket): the new master imports
+``main`` afresh, forks new workers and then stops the old ones, each
+draining its in-flight requests. If ``main`` no longer imports, the reload
+is refused and the running workers are kept. SIGTERM/SIGINT shut down
+gracefully. A worker that dies unexpectedly is replaced, after an
+exponentially growing delay while workers keep dying soon after boot.
+"""
+
+import argparse
+import logging
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import uvicorn
+
+logger = logging.getLogger("serve")
+
+GRACEFUL_TIMEOUT = 30.0
+# A worker that exits within MIN_UPTIME of its fork counts as a crash loop:
+# its replacement waits 0.5s, 1s, 2s, ... up to MAX_RESPAWN_DELAY.
+MIN_UPTIME = 10.0
+MAX_RESPAWN_DELAY = 30.0
+STARTUP_FAILURE = 3  # uvicorn's exit status when the app fails to start
+
+# Handed across the SIGHUP re-exec: the listening socket and the old workers.
+LISTEN_FD_ENV = "SERVE_LISTEN_FD"
+OLD_WORKERS_ENV = "SERVE_OLD_WORKERS"
+
+
+def _available(module: str) -> bool:
+    try:
+        __import__(module)
+        return True
+    except ImportError:
+        return False
+
+
+def _bind(host: str, port: int, backlog: int) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    # Explicit IPPROTO_TCP: asyncio only enables TCP_NODELAY on accepted sockets
+    # whose proto says TCP, and Nagle + delayed ACK would add ~40ms per response.
+    sock = socket.socket(family, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+class Master:
+    def __init__(self, app, sock: socket.socket, args, inherited=()):
+        self.app = app
+        self.sock = sock
+        self.args = args
+        self.workers = {}  # pid -> fork time
+        self.inherited = set(inherited)
+        self.stopping = False
+        self.reload_requested = False
+        self.crashes = 0
+        self.respawn_at = []
+
+    def _config(self) -> uvicorn.Config:
+        return uvicorn.Config(
+            self.app,
+            loop="uvloop" if _available("uvloop") else "asyncio",
+            http="httptools" if _available("httptools") else "h11",
+            log_level=self.args.log_level,
+            access_log=self.args.access_log,
+            backlog=self.args.backlog,
+            timeout_keep_alive=self.args.keep_alive,
+            timeout_graceful_shutdown=GRACEFUL_TIMEOUT,
+            proxy_headers=True,
+        )
+
+    def spawn(self) -> int:
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            return pid
+        # Worker: drop the master's handlers, uvicorn installs its own for TERM/INT.
+        for sig in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(sig, signal.SIG_DFL)
+        status = 1
+        try:
+            server = uvicorn.Server(self._config())
+            server.run(sockets=[self.sock])
+            status = 0 if server.started else STARTUP_FAILURE
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            logger.exception("Worker %s failed", os.getpid())
+        finally:
+            os._exit(status)
+
+    def _reap(self) -> list:
+        """``(pid, exit status, seconds alive)`` for every worker that has exited"""
+        exited = []
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if not pid:
+                break
+            if pid in self.workers:
+                exited.append((pid, os.waitstatus_to_exitcode(status), time.monotonic() - self.workers.pop(pid)))
+        return exited
+
+    def _wait_for(self, pids: set, timeout: float) -> None:
+        deadline = time.monotonic() + timeout
+        while pids & self.workers.keys() and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in pids & self.workers.keys():
+            logger.warning("Worker %s did not exit in %.0fs, killing", pid, timeout)
+            os.kill(pid, signal.SIGKILL)
+        self._reap()
+
+    def _retire(self, pids: set) -> None:
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+        self._wait_for(pids, GRACEFUL_TIMEOUT + 5)
+
+    def reexec(self) -> None:
+        """Replace this process with a fresh master that takes over the socket and workers"""
+        check = subprocess.run([sys.executable, "-c", "import main"], capture_output=True, text=True)
+        if check.returncode:
+            logger.error("Reload refused, main failed to import:\n%s", check.stderr.strip()[-2000:])
+            return
+        env = dict(os.environ)
+        env[LISTEN_FD_ENV] = str(self.sock.fileno())
+        env[OLD_WORKERS_ENV] = ",".join(map(str, self.workers))
+        logger.info("Reloading: re-executing master %s", os.getpid())
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execve(sys.executable, [sys.executable] + sys.argv, env)
+
+    def _respawn_delay(self, lifetime: float) -> float:
+        if lifetime >= MIN_UPTIME:
+            self.crashes = 0
+            return 0.0
+        self.crashes += 1
+        return min(MAX_RESPAWN_DELAY, 0.5 * 2 ** (self.crashes - 1))
+
+    def run(self) -> None:
+        signal.signal(signal.SIGHUP, lambda *_: setattr(self, "reload_requested", True))
+        signal.signal(signal.SIGTERM, lambda *_: setattr(self, "stopping", True))
+        signal.signal(signal.SIGINT, lambda *_: setattr(self, "stopping", True))
+
+        # Workers of the master we were re-executed from are still our children.
+        now = time.monotonic()
+        self.workers.update((pid, now) for pid in self.inherited)
+        for _ in range(self.args.workers):
+            self.spawn()
+        if self.inherited:
+            self._retire(self.inherited)
+            logger.info("Reloaded %d workers", len(self.workers))
+        logger.info("Master %s serving on %s:%s with %d workers",
+                    os.getpid(), self.args.host, self.args.port, self.args.workers)
+
+        while not self.stopping:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reexec()
+            for pid, status, lifetime in self._reap():
+                if not self.stopping:
+                    delay = self._respawn_delay(lifetime)
+                    logger.warning("Worker %s exited with status %s after %.1fs, respawning in %.1fs",
+                                   pid, status, lifetime, delay)
+                    self.respawn_at.append(time.monotonic() + delay)
+            now = time.monotonic()
+            for due in [t for t in self.respawn_at if t <= now]:
+                self.respawn_at.remove(due)
+                self.spawn()
+            time.sleep(0.2)
+
+        self._retire(set(self.workers))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.getenv("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("PORT", 8000)))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1)))
+    parser.add_argument("--backlog", type=int, default=2048)
+    parser.add_argument("--keep-alive", type=int, default=5, help="keep-alive timeout (seconds)")
+    parser.add_argument("--log-level", default=os.getenv("LOG_LEVEL", "info"))
+    parser.add_argument("--no-access-log", dest="access_log", action="store_false")
+    parser.add_argument("--dev", action="store_true", help="single process with auto-reload")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level.upper(), format="%(levelname)s:     [serve] %(message)s")
+
+    if args.dev:
+        uvicorn.run("main:app", host=args.host, port=args.port, reload=True, log_level=args.log_level)
+        return
+
+    # Import before forking so every worker shares the loaded code.
+    from main import app
+
+    inherited_fd = os.environ.pop(LISTEN_FD_ENV, None)
+    inherited = [int(pid) for pid in os.environ.pop(OLD_WORKERS_ENV, "").split(",") if pid]
+    if inherited_fd is not None:
+        sock = socket.socket(fileno=int(inherited_fd))
+        sock.set_inheritable(True)
+    else:
+        sock = _bind(args.host, args.port, args.backlog)
+    Master(app, sock, args, inherited).run()
+    sock.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,7 +2,7 @@
 echo "Starting FastAPI backend server..."
 
 # Find and kill MainThread processes
-PIDS=$(ps | grep uvicorn | grep -v grep | awk '{print $1}')
+PIDS=$(ps | grep -E 'uvicorn|serve.py' | grep -v grep | awk '{print $1}')
 if [ ! -z "$PIDS" ]; then
   echo "Killing uvicorn processes: $PIDS"
   for pid in $PIDS; do
@@ -15,5 +15,11 @@ mkdir -p logs
 echo "Installing dependencies..."
 pip install -r requirements.txt
 echo "Starting FastAPI server..."
-nohup uvicorn main:app --host 0.0.0.0 --port 8000 --reload > logs/server.log 2>&1 
+# APP_ENV=production runs the pre-forked multi-worker launcher; anything else
+# keeps the single-process auto-reloading dev server.
+if [ "$APP_ENV" = "production" ]; then
+  nohup python serve.py --host 0.0.0.0 --port 8000 > logs/server.log 2>&1 
+else
+  nohup python serve.py --dev --host 0.0.0.0 --port 8000 > logs/server.log 2>&1 
+fi
 echo "Server started in background"
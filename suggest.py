@@ -0,0 +1,257 @@
+"""
+Autocomplete Index
+
+In-process inverted index over product ``title``, ``description``,
+``category`` and ``colorways`` for ``/api/products/suggest``. Tokens map to
+posting lists of integer document ids (``array('I')``, ascending), and a
+prefix trie over the vocabulary keeps the most frequent completions at every
+node, so a keystroke is a trie walk plus a lazy merge/intersection of a few
+posting lists driven by the rarest term, with no Mongo round trip.
+
+The index is built at startup from the ``product`` collection. Products
+written through ``create_product`` are added incrementally and are
+suggestible immediately; every invalidation of the product collection (bulk
+import, other workers' writes via change streams) also schedules a rebuild,
+debounced by ``SUGGEST_REBUILD_DELAY`` seconds so a burst of writes costs one
+rebuild, and the new index is swapped in atomically.
+"""
+
+import asyncio
+import bisect
+import heapq
+import itertools
+import logging
+import os
+import re
+import sys
+import time
+import unicodedata
+from array import array
+from typing import Dict, Iterable, List, Optional, Union
+
+from pydantic import BaseModel
+
+from cache import on_invalidate
+from database import iter_documents_async
+
+logger = logging.getLogger(__name__)
+
+INDEX_ENABLED = os.getenv("SUGGEST_INDEX", "1") == "1"
+REBUILD_DELAY = float(os.getenv("SUGGEST_REBUILD_DELAY", "30"))
+TOP_COMPLETIONS = 8
+# Driver postings up to this length are probed by bisect instead of set-intersected.
+PROBE_LIMIT = 128
+
+FIELDS = ("title", "description", "category", "colorways")
+_TOKEN = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase, accent-folded alphanumeric tokens"""
+    folded = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode().lower()
+    return _TOKEN.findall(folded)
+
+
+def _contains(posting: array, doc_id: int) -> bool:
+    i = bisect.bisect_left(posting, doc_id)
+    return i < len(posting) and posting[i] == doc_id
+
+
+class _Node:
+    __slots__ = ("children", "top")
+
+    def __init__(self):
+        self.children: Dict[str, "_Node"] = {}
+        self.top: List[str] = []  # most frequent tokens under this prefix
+
+
+class ProductIndex:
+    """Inverted index + completion trie; mutated only from the event loop thread.
+
+    ``completions=False`` keeps only the postings (no trie), for callers that
+    match whole words.
+    """
+
+    def __init__(self, completions: bool = True):
+        self.keep_completions = completions
+        self.slugs: List[str] = []
+        self.titles: List[str] = []
+        self.postings: Dict[str, array] = {}
+        self.by_slug: Dict[str, int] = {}
+        self.root = _Node()
+
+    def __len__(self) -> int:
+        return len(self.slugs)
+
+    def add(self, product: Union[BaseModel, dict]) -> None:
+        doc = product.model_dump() if isinstance(product, BaseModel) else product
+        if doc["slug"] in self.by_slug:
+            return
+        text = " ".join([doc.get("title") or "", doc.get("description") or "", doc.get("category") or ""]
+                        + list(doc.get("colorways") or []))
+        tokens = tuple(dict.fromkeys(sys.intern(t) for t in tokenize(text)))
+        doc_id = len(self.slugs)
+        self.slugs.append(doc["slug"])
+        self.titles.append(doc.get("title") or "")
+        self.by_slug[doc["slug"]] = doc_id
+        for token in tokens:
+            posting = self.postings.get(token)
+            if posting is None:
+                posting = self.postings[token] = array("I")
+            posting.append(doc_id)  # ids only grow, so postings stay sorted
+            if self.keep_completions:
+                self._promote(token)
+
+    def _promote(self, token: str) -> None:
+        """Walk the trie path of ``token``, keeping it in each node's top completions"""
+        df = len(self.postings[token])
+        node = self.root
+        for ch in token:
+            node = node.children.get(ch) or node.children.setdefault(ch, _Node())
+            top = node.top
+            if token in top:
+                top.remove(token)
+            elif len(top) >= TOP_COMPLETIONS and df <= len(self.postings[top[-1]]):
+                continue
+            else:
+                del top[TOP_COMPLETIONS - 1:]
+            i = 0
+            while i < len(top) and len(self.postings[top[i]]) >= df:
+                i += 1
+            top.insert(i, token)
+
+    def completions(self, prefix: str) -> List[str]:
+        node = self.root
+        for ch in prefix:
+            node = node.children.get(ch)
+            if node is None:
+                return []
+        return list(node.top)
+
+    @staticmethod
+    def _match(groups: List[List[array]], limit: int) -> List[int]:
+        """Smallest ``limit`` ids present in at least one posting of every group.
+
+        The rarest group drives a lazy walk that probes the others by binary
+        search, which answers typical lookups after a handful of ids. If
+        ``PROBE_LIMIT`` ids go by without filling the page (a sparse
+        intersection of long postings), the rest is done as a set
+        intersection in C instead of a Python loop.
+        """
+        groups = sorted(groups, key=lambda g: sum(map(len, g)))
+        driver, others = groups[0], groups[1:]
+        ids = driver[0] if len(driver) == 1 else (k for k, _ in itertools.groupby(heapq.merge(*driver)))
+        found = []
+        for probed, doc_id in enumerate(ids):
+            if len(found) == limit:
+                return found
+            if probed == PROBE_LIMIT:
+                break
+            if all(any(_contains(p, doc_id) for p in group) for group in others):
+                found.append(doc_id)
+        else:
+            return found
+        rest = set(driver[0]).union(*driver[1:])
+        for group in others:
+            rest.intersection_update(group[0] if len(group) == 1 else set(group[0]).union(*group[1:]))
+        return heapq.nsmallest(limit, rest)
+
+    def suggest(self, q: str, limit: int = 10) -> dict:
+        """Completions for the last (partial) word and products matching every word.
+
+        The partial word matches through its top completions, so a product is
+        suggested when each finished word and one of those completions occur in it.
+        """
+        tokens = tokenize(q)
+        if not tokens:
+            return {"completions": [], "products": []}
+        partial = not q[-1:].isspace()
+        words, prefix = (tokens[:-1], tokens[-1]) if partial else (tokens, None)
+        completions = self.completions(prefix) if prefix else []
+
+        groups = [[self.postings.get(w)] for w in words]
+        if prefix:
+            groups.append([self.postings[t] for t in completions])
+        if not all(all(g) for g in groups):
+            return {"completions": completions, "products": []}
+        products = [{"slug": self.slugs[i], "title": self.titles[i]} for i in self._match(groups, limit)]
+        return {"completions": completions, "products": products}
+
+    def stats(self) -> dict:
+        return {
+            "products": len(self.slugs),
+            "tokens": len(self.postings),
+            "postings": sum(len(p) for p in self.postings.values()),
+            "posting_bytes": sum(p.itemsize * len(p) for p in self.postings.values()),
+        }
+
+
+def build_index(products: Iterable[Union[BaseModel, dict]]) -> ProductIndex:
+    index = ProductIndex()
+    for product in sorted(products, key=lambda p: p["slug"] if isinstance(p, dict) else p.slug):
+        index.add(product)
+    return index
+
+
+current: Optional[ProductIndex] = None
+_state = {"loads": 0, "errors": 0, "last_load_ms": 0.0}
+_rebuild_task: Optional[asyncio.Task] = None
+_dirty = False
+
+
+async def load_index() -> ProductIndex:
+    """Build a fresh index from Mongo and swap it in"""
+    global current
+    start = time.perf_counter()
+    projection = {"_id": 0, "slug": 1, **{f: 1 for f in FIELDS}}
+    docs = [doc async for doc in iter_documents_async("product", projection=projection) if doc.get("slug")]
+    current = build_index(docs)
+    _state["loads"] += 1
+    _state["last_load_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return current
+
+
+async def _rebuild():
+    global _rebuild_task, _dirty
+    try:
+        while True:
+            await asyncio.sleep(REBUILD_DELAY)
+            _dirty = False
+            try:
+                await load_index()
+            except Exception as e:
+                _state["errors"] += 1
+                logger.warning("Suggest index rebuild failed: %s", e)
+            if not _dirty:
+                break
+    finally:
+        _rebuild_task = None
+
+
+def request_rebuild():
+    """Schedule a debounced rebuild; coalesces with one already pending or running"""
+    global _rebuild_task, _dirty
+    if _rebuild_task is not None:
+        _dirty = True
+        return
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return
+    _rebuild_task = loop.create_task(_rebuild())
+
+
+def add_product(product: Union[BaseModel, dict]) -> None:
+    """Make a just-written product suggestible without waiting for a rebuild"""
+    if current is not None:
+        current.add(product)
+
+
+@on_invalidate
+def _on_invalidate(collection_name: str):
+    if INDEX_ENABLED and collection_name == "product" and current is not None:
+        request_rebuild()
+
+
+def stats() -> dict:
+    return {"enabled": INDEX_ENABLED, **(current.stats() if current else {}), **_state}